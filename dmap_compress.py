@@ -0,0 +1,369 @@
+# compressed dmap files, gzip, bz2 and zstd (with the optional zstandard package)
+# gzip and zstd files are written as independent blocks (gzip members or zstd frames) of fixed uncompressed size,
+# compressed in a pool of threads and written in order. gzip members carry their compressed and uncompressed sizes
+# in a header extra field and zstd files end with a seekable format seek table, so both can be read a block at a time
+# for random access. bz2 files are written as a single stream, as python 2's bz2.BZ2File only reads the first stream
+# of a file, compressed in one background thread. they have no block index, so bz2 files and files from other tools
+# are decompressed as a stream
+
+import numpy as np
+import bz2
+import multiprocessing
+import os
+import struct
+import zlib
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 1 << 22 # uncompressed bytes per block
+BLOCK_CACHE_SIZE = 4 # decompressed blocks kept by a block_reader
+READ_CHUNK = 1 << 20 # compressed bytes per read when streaming
+
+CODEC_EXTS = { \
+    '.gz':'gzip',\
+    '.bz2':'bz2',\
+    '.zst':'zstd'}
+
+DEF_LEVELS = { \
+    'gzip':6,\
+    'bz2':9,\
+    'zstd':3}
+
+CODEC_MAGICS = [ \
+    ('\x1f\x8b', 'gzip'),\
+    ('BZh', 'bz2'),\
+    ('\x28\xb5\x2f\xfd', 'zstd')]
+
+BLOCK_DTYPE = np.dtype([ \
+    ('coffset', np.int64),\
+    ('csize', np.int64),\
+    ('uoffset', np.int64),\
+    ('usize', np.int64)])
+
+# gzip member header with an extra field, subfield DM holding the member size and uncompressed size
+GZIP_HEADER = struct.Struct('<BBBBIBBH2sHII')
+GZIP_TRAILER = struct.Struct('<II')
+GZIP_FEXTRA = 4
+GZIP_OS_UNKNOWN = 255
+GZIP_SUBFIELD = 'DM'
+
+# zstd seekable format, a skippable frame of (compressed size, decompressed size) entries followed by a footer
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+ZSTD_SKIPPABLE_HEADER = struct.Struct('<II')
+ZSTD_SEEK_FOOTER = struct.Struct('<IBI')
+ZSTD_CHECKSUM_FLAG = 0x80
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compressed dmap files need the zstandard package')
+    return zstandard
+
+def extension_codec(filename):
+    ''' returns the codec for a filename's extension, None for uncompressed files '''
+    return CODEC_EXTS.get(os.path.splitext(filename)[1].lower())
+
+def file_codec(fp):
+    ''' returns the codec of an open file from its magic bytes, None for uncompressed files '''
+    fp.seek(0)
+    magic = fp.read(4)
+    fp.seek(0)
+    for prefix, codec in CODEC_MAGICS:
+        if magic.startswith(prefix):
+            return codec
+    return None
+
+def compress_block(codec, block, level):
+    ''' compresses block into an independent gzip member, bz2 stream or zstd frame (block_writer writes bz2 as one stream) '''
+    if codec == 'gzip':
+        deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = deflate.compress(block) + deflate.flush()
+        csize = GZIP_HEADER.size + len(data) + GZIP_TRAILER.size
+        header = GZIP_HEADER.pack(0x1f, 0x8b, zlib.DEFLATED, GZIP_FEXTRA, 0, 0, GZIP_OS_UNKNOWN, 12, GZIP_SUBFIELD, 8, csize, len(block))
+        return header + data + GZIP_TRAILER.pack(zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    if codec == 'bz2':
+        return bz2.compress(block, level)
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level = level).compress(block)
+    raise ValueError('unknown codec {}, expected one of {}'.format(codec, sorted(DEF_LEVELS)))
+
+def decompress_block(codec, data):
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if codec == 'bz2':
+        return bz2.decompress(data)
+    return _zstd().ZstdDecompressor().decompress(data)
+
+def zstd_seek_table(csizes, usizes):
+    ''' returns the seekable format skippable frame listing the frames of a zstd file '''
+    entries = np.empty((len(csizes), 2), dtype = '<u4')
+    entries[:,0] = csizes
+    entries[:,1] = usizes
+    table = entries.tobytes() + ZSTD_SEEK_FOOTER.pack(len(csizes), 0, ZSTD_SEEKABLE_MAGIC)
+    return ZSTD_SKIPPABLE_HEADER.pack(ZSTD_SKIPPABLE_MAGIC, len(table)) + table
+
+def make_blocks(csizes, usizes):
+    ''' returns a BLOCK_DTYPE block index from the compressed and uncompressed sizes of consecutive blocks '''
+    blocks = np.zeros(len(csizes), dtype = BLOCK_DTYPE)
+    blocks['csize'] = csizes
+    blocks['usize'] = usizes
+    blocks['coffset'][1:] = np.cumsum(blocks['csize'])[:-1]
+    blocks['uoffset'][1:] = np.cumsum(blocks['usize'])[:-1]
+    return blocks
+
+def gzip_blocks(fp, size):
+    ''' hops over the members of a gzip file written by block_writer, returns the block index or None for other gzip files '''
+    csizes = []
+    usizes = []
+    coffset = 0
+    while coffset < size:
+        fp.seek(coffset)
+        header = fp.read(GZIP_HEADER.size)
+        if len(header) < GZIP_HEADER.size:
+            return None
+        id1, id2, cm, flags, mtime, xfl, osid, xlen, subfield, sublen, csize, usize = GZIP_HEADER.unpack(header)
+        if (id1, id2, flags, subfield) != (0x1f, 0x8b, GZIP_FEXTRA, GZIP_SUBFIELD) or csize <= GZIP_HEADER.size:
+            return None
+        csizes.append(csize)
+        usizes.append(usize)
+        coffset += csize
+    return make_blocks(csizes, usizes)
+
+def zstd_blocks(fp, size):
+    ''' reads the seek table at the end of a seekable zstd file, returns the block index or None if there is none '''
+    if size < ZSTD_SKIPPABLE_HEADER.size + ZSTD_SEEK_FOOTER.size:
+        return None
+    fp.seek(size - ZSTD_SEEK_FOOTER.size)
+    nframes, descriptor, magic = ZSTD_SEEK_FOOTER.unpack(fp.read(ZSTD_SEEK_FOOTER.size))
+    if magic != ZSTD_SEEKABLE_MAGIC:
+        return None
+
+    entry = 3 if descriptor & ZSTD_CHECKSUM_FLAG else 2
+    tablesize = nframes * entry * 4 + ZSTD_SEEK_FOOTER.size
+    fp.seek(size - tablesize - ZSTD_SKIPPABLE_HEADER.size)
+    magic, framesize = ZSTD_SKIPPABLE_HEADER.unpack(fp.read(ZSTD_SKIPPABLE_HEADER.size))
+    if magic != ZSTD_SKIPPABLE_MAGIC or framesize != tablesize:
+        return None
+
+    entries = np.frombuffer(fp.read(nframes * entry * 4), dtype = '<u4').reshape(nframes, entry)
+    return make_blocks(entries[:,0], entries[:,1])
+
+BLOCK_INDEXERS = { \
+    'gzip':gzip_blocks,\
+    'zstd':zstd_blocks}
+
+def _stream_decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+def stream_chunks(fp, codec):
+    ''' yields the decompressed contents of a gzip, bz2 or zstd file of any number of members, streams or frames '''
+    fp.seek(0)
+    if codec == 'zstd':
+        reader = _zstd().ZstdDecompressor().stream_reader(fp, read_across_frames = True)
+        chunk = reader.read(READ_CHUNK)
+        while chunk:
+            yield chunk
+            chunk = reader.read(READ_CHUNK)
+        return
+
+    decompressor = _stream_decompressor(codec)
+    data = fp.read(READ_CHUNK)
+    while data:
+        # data left over at the end of a member or stream starts the next one
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except EOFError:
+                decompressor = _stream_decompressor(codec)
+                continue
+            data = decompressor.unused_data
+            if data:
+                decompressor = _stream_decompressor(codec)
+        data = fp.read(READ_CHUNK)
+
+class block_writer(object):
+    ''' write only file object compressing what is written to it in blocks of block_size bytes in a pool of threads
+        blocks are written in order as they finish, at most two per thread are held in memory
+        bz2 blocks all go through one compressor in a single thread, so the file is one bz2 stream '''
+    def __init__(self, filename, codec = None, level = None, block_size = BLOCK_SIZE, threads = None):
+        self.codec = codec or extension_codec(filename)
+        if self.codec not in DEF_LEVELS:
+            raise ValueError('unknown codec {} for {}, expected one of {}'.format(self.codec, filename, sorted(DEF_LEVELS)))
+        self.level = DEF_LEVELS[self.codec] if level is None else level
+        self.block_size = block_size
+        self.threads = threads or multiprocessing.cpu_count()
+        if self.codec == 'zstd':
+            _zstd()
+        self.stream = None
+        if self.codec == 'bz2':
+            self.stream = bz2.BZ2Compressor(self.level)
+            self.threads = 1
+
+        self.fp = open(filename, 'wb')
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.csizes = []
+        self.usizes = []
+
+    def _submit(self, block):
+        if self.stream is not None:
+            result = self.pool.apply_async(self.stream.compress, (block,))
+        else:
+            result = self.pool.apply_async(compress_block, (self.codec, block, self.level))
+        self.pending.append((len(block), result))
+        while len(self.pending) > 2 * self.threads:
+            self._drain()
+
+    def _drain(self):
+        ''' writes the oldest pending block once it is compressed '''
+        usize, result = self.pending.popleft()
+        data = result.get()
+        self.fp.write(data)
+        self.csizes.append(len(data))
+        self.usizes.append(usize)
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) < self.block_size:
+            return
+
+        nblocks = len(self.buf) // self.block_size
+        for b in range(nblocks):
+            self._submit(bytes(self.buf[b * self.block_size:(b + 1) * self.block_size]))
+        del self.buf[:nblocks * self.block_size]
+
+    def close(self):
+        if self.fp.closed:
+            return
+        try:
+            if self.buf:
+                self._submit(bytes(self.buf))
+                self.buf = bytearray()
+            while self.pending:
+                self._drain()
+            if self.stream is not None:
+                self.fp.write(self.stream.flush())
+            if self.codec == 'zstd':
+                self.fp.write(zstd_seek_table(self.csizes, self.usizes))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class block_reader(object):
+    ''' reads a compressed file, a block at a time if it has a block index (blocks is None if it doesn't) '''
+    def __init__(self, filename, threads = None):
+        self.filename = filename
+        self.threads = threads or multiprocessing.cpu_count()
+        self.fp = open(filename, 'rb')
+        self.codec = file_codec(self.fp)
+        if self.codec is None:
+            raise ValueError('{} is not a gzip, bz2 or zstd file'.format(filename))
+
+        indexer = BLOCK_INDEXERS.get(self.codec)
+        self.blocks = None if indexer is None else indexer(self.fp, os.fstat(self.fp.fileno()).st_size)
+        self.size = None if self.blocks is None else int(self.blocks['usize'].sum())
+        self.cache = OrderedDict()
+
+    def _readCompressed(self, blocknum):
+        block = self.blocks[blocknum]
+        self.fp.seek(block['coffset'])
+        return self.fp.read(block['csize'])
+
+    def readBlock(self, blocknum):
+        ''' returns decompressed block blocknum, keeping the last few used '''
+        data = self.cache.pop(blocknum, None)
+        if data is None:
+            data = decompress_block(self.codec, self._readCompressed(blocknum))
+        self.cache[blocknum] = data
+        while len(self.cache) > BLOCK_CACHE_SIZE:
+            self.cache.popitem(last = False)
+        return data
+
+    def read(self, offset, size):
+        ''' returns size bytes at uncompressed offset, only decompressing the blocks holding them '''
+        if self.blocks is None:
+            raise ValueError('{} has no block index, it can only be read as a whole'.format(self.filename))
+        blocknum = np.searchsorted(self.blocks['uoffset'], offset, side = 'right') - 1
+        pieces = []
+        end = offset + size
+        while offset < end and blocknum < len(self.blocks):
+            start = offset - self.blocks['uoffset'][blocknum]
+            piece = self.readBlock(blocknum)[start:start + end - offset]
+            pieces.append(piece)
+            offset += len(piece)
+            blocknum += 1
+        return pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
+    def chunks(self):
+        ''' yields the decompressed contents in order, blocks are decompressed in a pool of threads '''
+        if self.blocks is None:
+            for chunk in stream_chunks(self.fp, self.codec):
+                yield chunk
+            return
+
+        pool = ThreadPool(self.threads)
+        try:
+            compressed = (self._readCompressed(b) for b in range(len(self.blocks)))
+            for data in pool.imap(lambda data: decompress_block(self.codec, data), compressed):
+                yield data
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def readAll(self):
+        ''' returns the whole decompressed contents '''
+        if self.size is None:
+            return ''.join(self.chunks())
+        buf = bytearray(self.size)
+        offset = 0
+        for chunk in self.chunks():
+            buf[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return buf
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_output(filename, **kwargs):
+    ''' opens filename for writing, through a block_writer (taking its keyword arguments) if its extension is .gz, .bz2 or .zst '''
+    if extension_codec(filename) is None:
+        return open(filename, 'wb')
+    return block_writer(filename, **kwargs)
+
+def is_compressed(filename):
+    with open(filename, 'rb') as fp:
+        return file_codec(fp) is not None
+
+def read_chunks(filename, chunk_size = 1 << 24):
+    ''' yields the (decompressed) contents of a file in chunks '''
+    with open(filename, 'rb') as fp:
+        codec = file_codec(fp)
+    if codec is None:
+        with open(filename, 'rb') as fp:
+            chunk = fp.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = fp.read(chunk_size)
+        return
+
+    with block_reader(filename) as reader:
+        for chunk in reader.chunks():
+            yield chunk
@@ -0,0 +1,227 @@
+# converts row oriented dmap files into columnar hdf5 or npz files, one row per record
+# fixed shape fields become (nrecords, ...) arrays, fields indexed by slist are stored ragged
+# as the concatenated per record data plus a name.offsets array of nrecords + 1 record boundaries
+
+import numpy as np
+import os
+import sys
+from pydmap_read import dmap_file_reader
+from pydmap_index import record_time
+
+CHUNK_RECORDS = 256 # records converted and written per chunk
+COMPRESSION = 'gzip'
+OFFSETS_SUFFIX = '.offsets'
+TIME_COLUMN = 'time' # seconds since the unix epoch, see pydmap_index.record_time
+
+# vectors whose first dimension runs over the gates in slist, so their length changes from record to record
+SLIST_VECTORS = [ \
+    'slist',\
+    'acfd',\
+    'xcfd',\
+    'nlag',\
+    'qflg',\
+    'gflg',\
+    'p_l',\
+    'p_l_e',\
+    'p_s',\
+    'p_s_e',\
+    'v',\
+    'v_e',\
+    'w_l',\
+    'w_l_e',\
+    'w_s',\
+    'w_s_e',\
+    'sd_l',\
+    'sd_s',\
+    'sd_phi',\
+    'x_qflg',\
+    'x_gflg',\
+    'x_p_l',\
+    'x_p_l_e',\
+    'x_p_s',\
+    'x_p_s_e',\
+    'x_v',\
+    'x_v_e',\
+    'x_w_l',\
+    'x_w_l_e',\
+    'x_w_s',\
+    'x_w_s_e',\
+    'phi0',\
+    'phi0_e',\
+    'elv',\
+    'elv_low',\
+    'elv_high',\
+    'x_sd_l',\
+    'x_sd_s',\
+    'x_sd_phi']
+
+class hdf5_columns(object):
+    ''' appends columns to chunked, compressed, resizable datasets in an hdf5 file '''
+    def __init__(self, filename, chunk = CHUNK_RECORDS, compression = COMPRESSION):
+        import h5py
+        self.h5py = h5py
+        self.h5f = h5py.File(filename, 'w')
+        self.chunk = chunk
+        self.compression = compression
+
+    def append(self, name, data):
+        if data.dtype.kind == 'S':
+            data = data.astype(object)
+
+        if name not in self.h5f:
+            dtype = self.h5py.special_dtype(vlen = bytes) if data.dtype == object else data.dtype
+            chunks = (self.chunk,) + data.shape[1:] if not name.endswith(OFFSETS_SUFFIX) else True
+            self.h5f.create_dataset(name, shape = (0,) + data.shape[1:], maxshape = (None,) + data.shape[1:], \
+                    dtype = dtype, chunks = chunks, compression = self.compression)
+
+        dataset = self.h5f[name]
+        nrows = dataset.shape[0]
+        dataset.resize(nrows + len(data), axis = 0)
+        dataset[nrows:] = data
+
+    def close(self):
+        self.h5f.close()
+
+class npz_columns(object):
+    ''' collects columns in memory and writes them to a compressed npz file on close
+        npz files can't be appended to, so the whole output has to fit in memory '''
+    def __init__(self, filename, chunk = CHUNK_RECORDS, compression = COMPRESSION):
+        self.filename = filename
+        self.compression = compression
+        self.columns = {}
+
+    def append(self, name, data):
+        self.columns.setdefault(name, []).append(data)
+
+    def getColumns(self):
+        ''' returns the columns collected so far as a dict of arrays '''
+        return dict((name, np.concatenate(chunks)) for name, chunks in self.columns.items())
+
+    def close(self):
+        savez = np.savez_compressed if self.compression else np.savez
+        with open(self.filename, 'wb') as f:
+            savez(f, **self.getColumns())
+
+COLUMN_FORMATS = { \
+    '.h5':hdf5_columns,\
+    '.hdf5':hdf5_columns,\
+    '.npz':npz_columns}
+
+class dmap_columnizer(object):
+    ''' turns chunks of decoded records into columns and appends them to a hdf5_columns or npz_columns writer '''
+    def __init__(self, writer, ragged = SLIST_VECTORS, fields = None):
+        self.writer = writer
+        self.ragged = set(ragged)
+        self.fields = None if fields is None else set(fields)
+        self.scalars = None # scalar names, taken from the first record
+        self.vectors = None # fixed shape vector name -> shape, taken from the first record
+        self.ends = {} # ragged vector name -> rows written so far
+        self.nrecords = 0
+
+    def _selected(self, name):
+        return self.fields is None or name in self.fields
+
+    def _setColumns(self, scalars, vectors):
+        self.scalars = [name for name in scalars if self._selected(name)]
+        self.vectors = dict((name, vectors[name].shape) for name in vectors \
+                if self._selected(name) and name not in self.ragged)
+
+    def _appendRagged(self, name, rows):
+        ''' appends the rows of a ragged vector for every record of the chunk along with their end offsets '''
+        present = [r for r in rows if r is not None]
+        if not present:
+            if name not in self.ends:
+                return
+            trailing = None
+        else:
+            trailing = present[0].shape[1:]
+
+        lengths = np.array([0 if r is None else len(r) for r in rows], dtype = np.int64)
+
+        if name not in self.ends:
+            # first appearance, records before this chunk had none of it
+            self.ends[name] = 0
+            self.writer.append(name + OFFSETS_SUFFIX, np.zeros(self.nrecords + 1, dtype = np.int64))
+
+        if present:
+            if any(r.shape[1:] != trailing for r in present):
+                raise ValueError('ragged vector {} changes shape past its first dimension'.format(name))
+            self.writer.append(name, np.concatenate([r.reshape((-1,) + trailing) for r in present]))
+
+        self.writer.append(name + OFFSETS_SUFFIX, self.ends[name] + np.cumsum(lengths))
+        self.ends[name] += lengths.sum()
+
+    def append(self, records):
+        ''' appends a chunk of (scalars, vectors) records '''
+        if not records:
+            return
+        if self.scalars is None:
+            self._setColumns(*records[0])
+
+        base = self.nrecords
+        self.writer.append(TIME_COLUMN, np.array([record_time(s) for s, v in records], dtype = np.float64))
+
+        try:
+            for name in self.scalars:
+                self.writer.append(name, np.array([s[name] for s, v in records]))
+
+            for name, shape in self.vectors.items():
+                column = np.empty((len(records),) + shape, dtype = records[0][1][name].dtype)
+                for i, (s, v) in enumerate(records):
+                    if v[name].shape != shape:
+                        raise ValueError('vector {} in record {} changed shape from {} to {}, it should be stored ragged'.format(name, base + i, shape, v[name].shape))
+                    column[i] = v[name]
+                self.writer.append(name, column)
+        except KeyError as err:
+            raise ValueError('record in chunk starting at {} is missing field {}'.format(base, err))
+
+        ragged = set(name for s, v in records for name in v if name in self.ragged and self._selected(name))
+        for name in sorted(ragged | set(self.ends)):
+            self._appendRagged(name, [v.get(name) for s, v in records])
+
+        self.nrecords += len(records)
+
+def convert_dmap(filename, outname, chunk = CHUNK_RECORDS, ragged = SLIST_VECTORS, fields = None, compression = COMPRESSION):
+    ''' converts dmap file filename to a columnar file outname, the format is picked by the extension of outname (.h5, .hdf5 or .npz)
+        records are streamed from the file chunk at a time, returns the number of records converted '''
+    ext = os.path.splitext(outname)[1].lower()
+    if ext not in COLUMN_FORMATS:
+        raise ValueError('unknown columnar format {}, expected one of {}'.format(ext, sorted(COLUMN_FORMATS)))
+
+    writer = COLUMN_FORMATS[ext](outname, chunk = chunk, compression = compression)
+    columnizer = dmap_columnizer(writer, ragged = ragged, fields = fields)
+    try:
+        with dmap_file_reader(filename) as reader:
+            for start in range(0, len(reader), chunk):
+                columnizer.append([reader.readRecord(recnum) for recnum in range(start, min(start + chunk, len(reader)))])
+    finally:
+        writer.close()
+
+    return columnizer.nrecords
+
+def load_columns(filename):
+    ''' opens a converted file, returns a mapping of column name to array (npz) or dataset (hdf5) '''
+    if os.path.splitext(filename)[1].lower() == '.npz':
+        return np.load(filename)
+    import h5py
+    return h5py.File(filename, 'r')
+
+def ragged_rows(columns, name, recnum):
+    ''' returns the rows of ragged vector name belonging to record recnum '''
+    offsets = columns[name + OFFSETS_SUFFIX]
+    start, end = offsets[recnum], offsets[recnum + 1]
+    if start == end:
+        return np.zeros(0)
+    return columns[name][start:end]
+
+def main():
+    if len(sys.argv) < 3:
+        print 'usage: dmap_convert.py dmapfile outfile.[h5|hdf5|npz] [field,field..]'
+        return
+
+    fields = sys.argv[3].split(',') if len(sys.argv) > 3 else None
+    nrecords = convert_dmap(sys.argv[1], sys.argv[2], fields = fields)
+    print 'converted {} records'.format(nrecords)
+
+if __name__ == '__main__':
+    main()
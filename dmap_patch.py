@@ -0,0 +1,183 @@
+# patches fields of existing dmap files without decoding and re-encoding every record
+# fields are located from the record index offsets, new values are encoded with the field's existing type
+# and written in place through a writable mapping when every patched field keeps its size,
+# otherwise the file is streamed into a rewritten copy with the patched fields and record sizes spliced in
+
+import numpy as np
+import argparse
+import mmap
+import os
+import shutil
+from pydmap_codec import field_extent, field_layout, encode_field, HEADER_STRUCT, DATAMAP
+from pydmap_index import dmap_index, INDEX_SCALARS, TIME_FIELDS
+from dmap_tool import parse_time, TIME_FORMAT
+from dmap_compress import is_compressed
+
+COPY_CHUNK = 1 << 24 # bytes per write when streaming a rewrite
+PATCH_EXT = '.patch.tmp'
+
+INDEXED_FIELDS = set(INDEX_SCALARS + TIME_FIELDS + ['time.us'])
+
+class field_locator(object):
+    ''' finds a top level field in records, remembering where it was in the last record
+        records of one file almost always share their layout up to the field, so the remembered offset is checked first
+        and the record is only walked when the name, type code and scalar/vector kind found there don't match '''
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.prefix = None
+        self.vector = None
+
+    def locate(self, buf, offset):
+        ''' returns (start, payload, end, code, dims) of the field in the record at offset, None if the record doesn't have it '''
+        sze = HEADER_STRUCT.unpack_from(buf, offset)[1]
+        if self.start is not None and self.start + len(self.prefix) <= sze and \
+                buf[offset + self.start:offset + self.start + len(self.prefix)] == self.prefix:
+            start = offset + self.start
+            name, code, dims, payload, end = field_extent(buf, start, self.vector)
+            return start, payload, end, code, dims
+
+        layout = field_layout(buf, offset).get(self.name)
+        if layout is None:
+            return None
+        start, payload, end, code, dims = layout
+        self.start = start - offset
+        self.prefix = buf[start:payload - (0 if dims is None else 4 * (len(dims) + 1))]
+        self.vector = dims is not None
+        return layout
+
+def conform_value(name, value, dims):
+    ''' shapes a new vector value like the stored field, dims as stored (reversed from the numpy shape)
+        single values are broadcast over the field and flat values are reshaped if their element count matches '''
+    shape = tuple(dims[::-1])
+    value = np.asarray(value)
+    if value.shape == shape:
+        return value
+    if value.size == 1:
+        return np.array(np.broadcast_to(value.reshape(()), shape))
+    if value.size == int(np.prod(shape)):
+        return value.reshape(shape)
+    raise ValueError('{} values for vector {} of shape {}'.format(value.size, name, shape))
+
+def record_patches(buf, offset, locators, values):
+    ''' returns the (start, end, bytes) patches setting the fields of the record at offset to values, in file order
+        a patch of the record header with the new record size is included when the record changes size '''
+    patches = []
+    for locator, value in zip(locators, values):
+        field = locator.locate(buf, offset)
+        if field is None:
+            raise KeyError('record at offset {} has no field {}'.format(offset, locator.name))
+        start, payload, end, code, dims = field
+        if code == DATAMAP:
+            raise ValueError('can\'t patch map field {}'.format(locator.name))
+        if dims is not None:
+            value = conform_value(locator.name, value, dims)
+        patches.append((start, end, encode_field(locator.name, code, value, dims is not None)))
+
+    growth = sum(len(data) - (end - start) for start, end, data in patches)
+    if growth:
+        datacode, sze, snum, anum = HEADER_STRUCT.unpack_from(buf, offset)
+        patches.append((offset, offset + HEADER_STRUCT.size, HEADER_STRUCT.pack(datacode, sze + growth, snum, anum)))
+
+    return sorted(patches)
+
+def write_in_place(buf, patches):
+    for start, end, data in patches:
+        buf[start:end] = data
+
+def write_rewrite(buf, patches, outname):
+    ''' streams buf to outname with the byte ranges of patches replaced '''
+    with open(outname, 'wb') as out:
+        pos = 0
+        for start, end, data in patches + [(len(buf), len(buf), '')]:
+            while pos < start:
+                out.write(buf[pos:min(pos + COPY_CHUNK, start)])
+                pos = min(pos + COPY_CHUNK, start)
+            out.write(data)
+            pos = end
+
+def refresh_index(index, names, rewritten):
+    ''' updates the saved index of a patched file, rebuilt if record offsets or indexed fields changed, otherwise only restamped '''
+    if not os.path.exists(index.indexname):
+        return
+    if rewritten or INDEXED_FIELDS.intersection(names):
+        dmap_index(index.filename, rebuild = True)
+    else:
+        stat = os.stat(index.filename)
+        index.stamp[1:] = [stat.st_size, stat.st_mtime]
+        index._save()
+
+def patch_fields(filename, fields, recnums = None, per_record = False, index = None):
+    ''' sets the top level fields of records recnums (every record by default) of filename, fields is a dict of name -> value
+        values are cast to the field's type in the file and vectors keep their shape (see conform_value),
+        per_record if each value is a sequence with one value per patched record
+        returns True if the file was patched in place, False if it had to be rewritten because a string changed length '''
+    if is_compressed(filename):
+        raise ValueError('can\'t patch compressed file {}, decompress it first'.format(filename))
+    if index is None:
+        index = dmap_index(filename, save = False)
+    if recnums is None:
+        recnums = np.arange(len(index))
+    recnums = np.asarray(recnums, dtype = np.int64)
+
+    names = list(fields)
+    locators = [field_locator(name) for name in names]
+    if per_record:
+        for name in names:
+            if len(fields[name]) != len(recnums):
+                raise ValueError('{} values for field {}, patching {} records'.format(len(fields[name]), name, len(recnums)))
+
+    with open(filename, 'r+b') as f:
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_WRITE)
+        try:
+            patches = []
+            for i, offset in enumerate(index.records['offset'][recnums]):
+                values = [fields[name][i] if per_record else fields[name] for name in names]
+                patches.extend(record_patches(buf, int(offset), locators, values))
+
+            in_place = all(len(data) == end - start for start, end, data in patches)
+            if in_place:
+                write_in_place(buf, patches)
+                buf.flush()
+            else:
+                write_rewrite(buf, sorted(patches), filename + PATCH_EXT)
+        finally:
+            buf.close()
+
+    if not in_place:
+        shutil.copymode(filename, filename + PATCH_EXT)
+        os.rename(filename + PATCH_EXT, filename)
+
+    refresh_index(index, names, not in_place)
+    return in_place
+
+def patch_field(filename, name, value, recnums = None, per_record = False, index = None):
+    ''' sets one field, see patch_fields '''
+    return patch_fields(filename, {name : value}, recnums, per_record, index)
+
+def parse_value(value):
+    ''' command line values, comma separated values are vectors '''
+    if ',' in value:
+        return value.split(',')
+    return value
+
+def main():
+    parser = argparse.ArgumentParser(description = 'patch fields of the records of a dmap file')
+    parser.add_argument('input')
+    parser.add_argument('fields', nargs = '+', help = 'name=value, comma separated values for vectors')
+    parser.add_argument('--stime', type = parse_time, help = 'start time, ' + TIME_FORMAT.replace('%', '%%'))
+    parser.add_argument('--etime', type = parse_time, help = 'end time (exclusive)')
+    for field in ['bmnum', 'channel', 'cp', 'scan']:
+        parser.add_argument('--' + field, type = int)
+    args = parser.parse_args()
+
+    fields = dict((f.split('=', 1)[0], parse_value(f.split('=', 1)[1])) for f in args.fields)
+    index = dmap_index(args.input, save = False)
+    recnums = index.query(stime = args.stime, etime = args.etime, \
+            bmnum = args.bmnum, channel = args.channel, cp = args.cp, scan = args.scan)
+
+    in_place = patch_fields(args.input, fields, recnums, index = index)
+    print 'patched {} records {}'.format(len(recnums), 'in place' if in_place else 'by rewriting the file')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# command line tool to concatenate, time merge, split and filter dmap files
+# records are routed using the record index (only the scalars are decoded, and only when no saved index exists)
+# and copied as raw byte ranges, adjacent records are coalesced into single copies
+# inputs may be gzip, bz2 or zstd compressed, outputs named .gz, .bz2 or .zst are compressed
+
+import numpy as np
+import argparse
+import datetime
+import os
+from pydmap_index import dmap_index
+from dmap_compress import open_output, read_chunks
+
+COPY_CHUNK = 1 << 24 # bytes per write when copying through the mapping
+TIME_FORMAT = '%Y%m%d.%H%M'
+
+SPLIT_KEYS = ['hour', 'beam', 'channel']
+NO_HOUR = -1 # hour split key of records without a valid time
+
+def coalesce_ranges(offsets, sizes):
+    ''' merges byte ranges that follow each other into single ranges, returns their offsets and sizes '''
+    offsets = np.asarray(offsets, dtype = np.int64)
+    sizes = np.asarray(sizes, dtype = np.int64)
+    if not len(offsets):
+        return offsets, sizes
+
+    # a range starts a new run unless it begins where the last one ended
+    starts = np.ones(len(offsets), dtype = bool)
+    starts[1:] = offsets[1:] != offsets[:-1] + sizes[:-1]
+    run = np.cumsum(starts) - 1
+    return offsets[starts], np.bincount(run, weights = sizes).astype(np.int64)
+
+def copy_ranges(reader, out, offsets, sizes):
+    ''' copies byte ranges of the file open in a dmap_file_reader to file object out, without decoding them
+        uses os.sendfile between uncompressed files where available, otherwise writes slices of the reader's mapping '''
+    offsets, sizes = coalesce_ranges(offsets, sizes)
+    sendfile = hasattr(os, 'sendfile') and reader.codec is None and isinstance(out, file)
+    if sendfile:
+        out.flush()
+    for offset, size in zip(offsets, sizes):
+        offset, end = int(offset), int(offset + size)
+        if sendfile:
+            while offset < end:
+                offset += os.sendfile(out.fileno(), reader.fp.fileno(), offset, end - offset)
+        else:
+            while offset < end:
+                out.write(reader.readBytes(offset, min(COPY_CHUNK, end - offset)))
+                offset = min(offset + COPY_CHUNK, end)
+
+def copy_records(index, reader, out, recnums):
+    ''' copies records recnums of an indexed file, open in reader (from index.open), to out in the given order '''
+    records = index.records[np.asarray(recnums, dtype = np.int64)]
+    copy_ranges(reader, out, records['offset'], records['sze'])
+
+def cat_files(filenames, outname):
+    ''' concatenates whole files, decompressing and compressing them as needed '''
+    with open_output(outname) as out:
+        for filename in filenames:
+            for chunk in read_chunks(filename, COPY_CHUNK):
+                out.write(chunk)
+
+def merge_files(filenames, outname):
+    ''' merges the records of files into time order, records with the same time keep the order of the files '''
+    indexes = [dmap_index(filename, save = False) for filename in filenames]
+    times = np.concatenate([index.records['time'] for index in indexes])
+    files = np.concatenate([np.full(len(index), i, dtype = np.int64) for i, index in enumerate(indexes)])
+    recnums = np.concatenate([np.arange(len(index)) for index in indexes])
+
+    order = np.argsort(times, kind = 'mergesort')
+    files = files[order]
+    recnums = recnums[order]
+
+    # copy runs of records coming from the same file together, each file is opened (and decompressed) once
+    readers = [index.open() for index in indexes]
+    try:
+        with open_output(outname) as out:
+            breaks = np.flatnonzero(np.diff(files)) + 1
+            for start, end in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(files)]])):
+                copy_records(indexes[files[start]], readers[files[start]], out, recnums[start:end])
+    finally:
+        for reader in readers:
+            reader.close()
+
+def split_keys(index, key):
+    ''' returns the split key (hour, beam or channel) of every record of an index '''
+    if key == 'hour':
+        times = index.records['time']
+        valid = ~np.isnan(times)
+        hours = np.full(len(times), NO_HOUR, dtype = np.int64)
+        hours[valid] = times[valid] // 3600
+        return hours
+    if key == 'beam':
+        return index.records['bmnum'].astype(np.int64)
+    if key == 'channel':
+        return index.records['channel'].astype(np.int64)
+    raise ValueError('unknown split key {}, expected one of {}'.format(key, SPLIT_KEYS))
+
+def split_name(pattern, key, value):
+    ''' fills the {} in pattern with the split value, hours as YYYYmmdd.HH and records without a valid time as unknown '''
+    if key == 'hour' and value == NO_HOUR:
+        value = 'unknown'
+    elif key == 'hour':
+        value = datetime.datetime.utcfromtimestamp(value * 3600).strftime('%Y%m%d.%H')
+    return pattern.format(value)
+
+def split_file(filename, pattern, key):
+    ''' splits a file by hour, beam or channel into files named by pattern, returns the names written '''
+    index = dmap_index(filename, save = False)
+    keys = split_keys(index, key)
+    outnames = []
+    with index.open() as reader:
+        for value in np.unique(keys):
+            outname = split_name(pattern, key, value)
+            with open_output(outname) as out:
+                copy_records(index, reader, out, np.flatnonzero(keys == value))
+            outnames.append(outname)
+    return outnames
+
+def filter_file(filename, outname, **query):
+    ''' copies the records matching dmap_index.query(**query) to outname, returns the number of records copied '''
+    index = dmap_index(filename, save = False)
+    recnums = index.query(**query)
+    with index.open() as reader, open_output(outname) as out:
+        copy_records(index, reader, out, recnums)
+    return len(recnums)
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, TIME_FORMAT)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'concatenate, merge, split and filter dmap files')
+    commands = parser.add_subparsers(dest = 'command')
+
+    cat = commands.add_parser('cat', help = 'concatenate files')
+    cat.add_argument('output')
+    cat.add_argument('inputs', nargs = '+')
+
+    merge = commands.add_parser('merge', help = 'merge files into time order')
+    merge.add_argument('output')
+    merge.add_argument('inputs', nargs = '+')
+
+    split = commands.add_parser('split', help = 'split a file by hour, beam or channel')
+    split.add_argument('key', choices = SPLIT_KEYS)
+    split.add_argument('input')
+    split.add_argument('pattern', help = 'output name with {} for the hour, beam or channel')
+
+    filt = commands.add_parser('filter', help = 'copy the records matching a query')
+    filt.add_argument('input')
+    filt.add_argument('output')
+    filt.add_argument('--stime', type = parse_time, help = 'start time, ' + TIME_FORMAT.replace('%', '%%'))
+    filt.add_argument('--etime', type = parse_time, help = 'end time (exclusive)')
+    for field in ['bmnum', 'channel', 'cp', 'scan']:
+        filt.add_argument('--' + field, type = int)
+
+    args = parser.parse_args()
+
+    if args.command == 'cat':
+        cat_files(args.inputs, args.output)
+    elif args.command == 'merge':
+        merge_files(args.inputs, args.output)
+    elif args.command == 'split':
+        for outname in split_file(args.input, args.pattern, args.key):
+            print outname
+    elif args.command == 'filter':
+        nrecords = filter_file(args.input, args.output, stime = args.stime, etime = args.etime, \
+                bmnum = args.bmnum, channel = args.channel, cp = args.cp, scan = args.scan)
+        print 'copied {} records'.format(nrecords)
+
+if __name__ == '__main__':
+    main()
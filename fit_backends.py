@@ -0,0 +1,290 @@
+# fitter backends sharing one interface, so comparisons and benchmarks can swap fitters by name
+# backends needing rst, cuda or the FitLOMB repository only import them when they are run
+
+import numpy as np
+import os
+import subprocess
+from pydmap_read import dmap_file_reader
+from pydmap_index import record_time
+from superdarn_tools import C, LAMBDA_FIT, calc_noise
+from fit_compare import fitacf_gates, fitlomb_gates, GATE_DTYPE
+from lag_cache import lru_cache, record_lag_table
+
+FITLOMB_PATH = '../SuperDARN_FitLOMB'
+
+# lomb/bayes grid
+MAX_TFREQ = 16e6
+LOMB_PASSES = 1
+NFREQS = 256
+NALFS = 256
+FWHM_TO_SIGMA = 2.355 # conversion of fwhm to std deviation, assuming gaussian
+MAX_V = 2000 # m/s, max velocity (doppler shift) to include in lomb
+MAX_W = 1200 # m/s, max spectral width to include in lomb
+
+QUALITY_THRESHOLD = .5 # fraction of the acf power the best model has to explain for a gate to count as fitted
+GATE_BATCH = 32 # gates fitted per batch, bounds the (gates, freqs, alfs) posterior arrays
+
+HDF5_EXTS = ['.h5', '.hdf5']
+FITLOMB_FIELDS = ['v', 'v_e', 'w_l', 'w_l_e', 'p_l', 'nlag']
+
+def lomb_grid(nfreqs = NFREQS, nalfs = NALFS):
+    ''' returns the frequencies (Hz) and decay rates (1/s) searched by the lomb fitters '''
+    amax = np.ceil((np.pi * 2 * MAX_TFREQ * MAX_W) / C)
+    fmax = np.ceil(MAX_V * 2 * MAX_TFREQ / C)
+    freqs = np.linspace(-fmax, fmax, nfreqs)
+    alfs = np.linspace(0, amax, nalfs)
+    return freqs, alfs
+
+def rescale_velocity(f, tfreq):
+    ''' inverse of superdarn_tools.descale_velocity, doppler shift f (Hz) to velocity (m/s), tfreq in kHz '''
+    return f * C / (2. * tfreq * 1000)
+
+def rescale_width(alf, tfreq):
+    ''' inverse of superdarn_tools.descale_width, decay rate (1/s) to spectral width (m/s), tfreq in kHz '''
+    return alf * C / (2. * np.pi * tfreq * 1000)
+
+class fit_backend(object):
+    ''' interface shared by the fitters, fit writes the fit of a rawacf file to fitname and readGates
+        returns the fitted gates of that file as a fit_compare gate table
+        calling a backend does both, so backends can be handed to fit_benchmark as fitters '''
+    def fit(self, rawacfname, fitname):
+        raise NotImplementedError
+
+    def readGates(self, fitname):
+        raise NotImplementedError
+
+    def __call__(self, rawacfname, fitname):
+        self.fit(rawacfname, fitname)
+        return self.readGates(fitname)
+
+class make_fit_backend(fit_backend):
+    ''' rst make_fit run as a subprocess, writes a fitacf file '''
+    def __init__(self, command = 'make_fit', args = ['-new']):
+        self.command = command
+        self.args = args
+
+    def fit(self, rawacfname, fitname):
+        with open(fitname, 'wb') as f:
+            subprocess.check_call([self.command] + list(self.args) + [rawacfname], stdout = f)
+
+    def readGates(self, fitname):
+        return fitacf_gates(fitname)
+
+class cuda_lomb_backend(fit_backend):
+    ''' FitLOMB's cuda lambda fitter, writes a fitlomb hdf5 file
+        the rawacf is found through pydarn by radar and start time, so it has to sit under sandbox in davit's layout '''
+    def __init__(self, sandbox, radar, stime, etime = None, model = LAMBDA_FIT):
+        self.sandbox = sandbox
+        self.radar = radar
+        self.stime = stime
+        self.etime = etime
+        self.model = model
+
+    def fit(self, rawacfname, fitname):
+        import sys
+        import h5py
+        import pydarn.sdio as sdio
+        sys.path.append(FITLOMB_PATH)
+        import lagstate
+        from cuda_bayes import BayesGPU
+        from pydarncuda_fitlomb import CULombFit
+
+        os.environ['DAVIT_LOCALDIR'] = self.sandbox
+        os.environ['DAVIT_DIRFORMAT'] = '%(dirtree)s/'
+
+        hdf5file = h5py.File(fitname, 'w')
+
+        myPtr = sdio.radDataOpen(self.stime,self.radar,eTime=self.etime,channel=None,bmnum=None,cp=None,fileType='rawacf',filtered=False, src='local', noCache = True)
+        drec = sdio.radDataReadRec(myPtr)
+
+        freqs, alfs = lomb_grid()
+
+        fit = CULombFit(drec)
+        gpu_lambda = BayesGPU(fit.lags, freqs, alfs, fit.nrang, self.model)
+        txlag_cache = lagstate.good_lags_txsamples(fit)
+        fit.SetBadlags(txlag_cache = txlag_cache)
+        fit.CudaProcessPulse(gpu_lambda)
+        fit.CudaCopyPeaks(gpu_lambda)
+        fit.WriteLSSFit(hdf5file)
+        hdf5file.close()
+
+    def readGates(self, fitname):
+        return fitlomb_gates(fitname)
+
+class numpy_lomb_backend(fit_backend):
+    ''' cpu bayesian lomb fitter, evaluates the LAMBDA_FIT or SIGMA_FIT decay model over the whole freqs x alfs grid
+        for every gate of a record at once with batched matrix products and takes the peak of the posterior,
+        errors are the fwhm of the marginal posteriors over frequency and decay rate converted to standard deviations
+        fits are written in the fitlomb hdf5 layout (one group per record, fields indexed by gate) if fitname ends in .h5 or .hdf5,
+        otherwise as a gate table in an npy file, p_l is the lag 0 power of the fitted model over the record noise in dB, as in fitacf,
+        nlag counts the lags fitted, which leaves out lag 0 '''
+    def __init__(self, model = LAMBDA_FIT, nfreqs = NFREQS, nalfs = NALFS, gate_batch = GATE_BATCH):
+        self.model = model
+        self.freqs, self.alfs = lomb_grid(nfreqs, nalfs)
+        self.gate_batch = gate_batch
+        self.designs = lru_cache() # lag times -> (phasors, decay)
+
+    def getDesign(self, lags):
+        ''' returns the frequency phasors (nfreqs, nlags) and the decay envelopes (nalfs, nlags) for the lag times of a lag_table '''
+        key = lags.lagt.tobytes()
+        design = self.designs.get(key)
+        if design is None:
+            lagt = lags.lagt.astype(np.float64)
+            phasors = np.exp(-2j * np.pi * np.outer(self.freqs, lagt)).astype(np.complex64)
+            decay = np.exp(-np.power(np.outer(self.alfs, lagt), self.model)).astype(np.float32)
+            design = (phasors, decay)
+            self.designs.put(key, design)
+        return design
+
+    def fitGates(self, samples, phasors, decay, goodlags = None):
+        ''' fits complex acf samples (ngates, nlags), goodlags is an optional (ngates, nlags) mask of usable lags
+            returns per gate frequency, decay rate, amplitude, explained power fraction, frequency and decay rate fwhm and good lag count,
+            the fwhm are only computed for gates explaining at least QUALITY_THRESHOLD of their power '''
+        ngates, nlags = samples.shape
+        if goodlags is None:
+            goodlags = np.ones(samples.shape, dtype = bool)
+        samples = np.where(goodlags, samples, 0).astype(np.complex64)
+        nfreqs, nalfs = len(self.freqs), len(self.alfs)
+
+        # projections onto every model m = exp(2j pi f t) * exp(-(alf t) ^ model), the envelope is real
+        # so only the real part of the phase shifted samples is needed: (ngates * nfreqs, nlags) x (nlags, nalfs)
+        shifted = (samples[:,np.newaxis,:] * phasors).real.reshape(ngates * nfreqs, nlags)
+        proj = np.dot(shifted, decay.T).reshape(ngates, nfreqs, nalfs)
+
+        # model power depends on which lags of a gate are good, h2 = proj ^ 2 / model power
+        mpower = np.dot(goodlags.astype(np.float32), (decay ** 2).T)[:,np.newaxis,:]
+        h2 = np.square(proj, out = proj)
+        h2 /= mpower
+
+        flat = np.argmax(h2.reshape(ngates, -1), axis = 1)
+        fidx, aidx = np.unravel_index(flat, (nfreqs, nalfs))
+        gidx = np.arange(ngates)
+
+        d2 = np.sum(np.abs(samples) ** 2, axis = 1)
+        d2[d2 == 0] = 1
+        peak = h2[gidx, fidx, aidx]
+        explained = peak / d2
+        # the projection at the peak has the sign of the amplitude
+        amplitude = np.sum(shifted.reshape(ngates, nfreqs, nlags)[gidx, fidx] * decay[aidx], axis = 1) / mpower[gidx, 0, aidx]
+
+        # student t posterior for one amplitude over 2n real samples (bretthorst), normalized to a peak of one,
+        # its marginals give the errors, only worth evaluating for gates that are kept
+        f_fwhm = np.zeros(ngates)
+        a_fwhm = np.zeros(ngates)
+        kept = np.flatnonzero(explained >= QUALITY_THRESHOLD)
+        if len(kept):
+            nreal = 2 * goodlags[kept].sum(axis = 1).reshape(-1, 1, 1)
+            frac = np.minimum(h2[kept] / d2[kept].reshape(-1, 1, 1), 1 - 1e-6)
+            peakfrac = np.minimum(explained[kept], 1 - 1e-6).reshape(-1, 1, 1)
+            posterior = np.exp((1. - nreal) / 2. * (np.log1p(-frac) - np.log1p(-peakfrac)))
+
+            f_fwhm[kept] = fwhm(posterior.sum(axis = 2), self.freqs)
+            a_fwhm[kept] = fwhm(posterior.sum(axis = 1), self.alfs)
+
+        return self.freqs[fidx], self.alfs[aidx], amplitude, explained, f_fwhm, a_fwhm, goodlags.sum(axis = 1)
+
+    def fitRecord(self, scalars, vectors):
+        ''' fits every gate of a decoded rawacf record, returns a gate table with a row for every gate, nlag is zero for unfitted gates
+            lags blanked by the transmitter at a gate are left out of its fit '''
+        lags = record_lag_table(scalars, vectors)
+        phasors, decay = self.getDesign(lags)
+        acfd = vectors['acfd']
+        samples = acfd[:,:,0] + 1j * acfd[:,:,1].astype(np.float64)
+        ngates = len(samples)
+        tfreq = scalars['tfreq']
+        noise = record_noise(scalars, vectors)
+
+        fitted = np.zeros(ngates, dtype = GATE_DTYPE)
+        fitted['time'] = record_time(scalars)
+        fitted['bmnum'] = scalars['bmnum']
+        fitted['channel'] = scalars.get('channel', 0)
+        fitted['gate'] = vectors['slist'] if 'slist' in vectors else np.arange(ngates)
+        # lag 0 carries the noise power, which the low biased record noise can't remove, and would let noise only gates
+        # pass as fitted, so the models are fit to the other lags and their amplitude at lag 0 is the fitted power
+        goodlags = lags.goodLags(fitted['gate']) & (lags.lagnums != 0)
+
+        for start in range(0, ngates, self.gate_batch):
+            batch = slice(start, min(start + self.gate_batch, ngates))
+            f, alf, amplitude, explained, f_fwhm, a_fwhm, nlag = \
+                    self.fitGates(samples[batch], phasors, decay, goodlags[batch])
+
+            good = explained >= QUALITY_THRESHOLD
+            fitted['v'][batch] = np.where(good, rescale_velocity(f, tfreq), 0)
+            fitted['v_e'][batch] = np.where(good, rescale_velocity(f_fwhm, tfreq) / FWHM_TO_SIGMA, 0)
+            fitted['w_l'][batch] = np.where(good, rescale_width(alf, tfreq), 0)
+            fitted['w_l_e'][batch] = np.where(good, rescale_width(a_fwhm, tfreq) / FWHM_TO_SIGMA, 0)
+            fitted['p_l'][batch] = np.where(good & (amplitude > 0), 10 * np.log10(np.maximum(amplitude, 1e-30) / noise), 0)
+            fitted['nlag'][batch] = np.where(good, nlag, 0)
+
+        return fitted
+
+    def fit(self, rawacfname, fitname):
+        hdf5 = os.path.splitext(fitname)[1].lower() in HDF5_EXTS
+        if hdf5:
+            import h5py
+            out = h5py.File(fitname, 'w')
+        gates = []
+
+        with dmap_file_reader(rawacfname) as reader:
+            for recnum, (scalars, vectors) in enumerate(reader):
+                fitted = self.fitRecord(scalars, vectors)
+                if hdf5:
+                    write_fitlomb_group(out, '{:08d}'.format(recnum), scalars, fitted)
+                else:
+                    gates.append(fitted[fitted['nlag'] > 0])
+
+        if hdf5:
+            out.close()
+        else:
+            gates = np.concatenate(gates) if gates else np.zeros(0, dtype = GATE_DTYPE)
+            with open(fitname, 'wb') as f:
+                np.save(f, gates)
+
+    def readGates(self, fitname):
+        if os.path.splitext(fitname)[1].lower() in HDF5_EXTS:
+            return fitlomb_gates(fitname)
+        return np.load(fitname)
+
+def record_noise(scalars, vectors):
+    ''' returns the noise level of a rawacf record, its noise.search, or noise.mean if that isn't positive
+        (with few averages pwr0 of noise only gates is often negative), or else estimated from |pwr0| like fitacf '''
+    noise = scalars.get('noise.search', 0)
+    if noise <= 0:
+        noise = scalars.get('noise.mean', 0)
+    if noise <= 0 and 'pwr0' in vectors:
+        pwr0 = np.abs(np.asarray(vectors['pwr0'], dtype = np.float64))
+        noise = calc_noise(pwr0, pwr0[:,np.newaxis])[0]
+    return max(float(noise), 1e-30)
+
+def fwhm(marginals, grid):
+    ''' returns the full width at half maximum of each row of marginals over evenly spaced grid,
+        counted as the number of grid points above half the peak '''
+    peaks = marginals.max(axis = 1).reshape(-1, 1)
+    return np.sum(marginals >= peaks / 2., axis = 1) * (grid[1] - grid[0])
+
+def write_fitlomb_group(h5f, name, scalars, fitted):
+    ''' writes the fit of a record as a group of per gate datasets, with the record's scalars as attributes '''
+    group = h5f.create_group(name)
+    for scalar, value in scalars.items():
+        group.attrs[scalar] = value
+
+    nrang = int(scalars.get('nrang', fitted['gate'].max() + 1))
+    for field in FITLOMB_FIELDS:
+        data = np.zeros(nrang, dtype = GATE_DTYPE[field])
+        data[fitted['gate']] = fitted[field]
+        group.create_dataset(field, data = data)
+
+FIT_BACKENDS = { \
+    'make_fit':make_fit_backend,\
+    'cuda_lomb':cuda_lomb_backend,\
+    'numpy_lomb':numpy_lomb_backend}
+
+def get_backend(name, *args, **kwargs):
+    ''' returns an instance of the backend registered as name, constructed with args and kwargs '''
+    if name not in FIT_BACKENDS:
+        raise ValueError('unknown fit backend {}, expected one of {}'.format(name, sorted(FIT_BACKENDS)))
+    return FIT_BACKENDS[name](*args, **kwargs)
+
+def register_backend(name, backend):
+    ''' registers a fit_backend subclass under name '''
+    FIT_BACKENDS[name] = backend
@@ -0,0 +1,161 @@
+# monte-carlo accuracy and throughput benchmark of fitters over a grid of synthetic scatter parameters
+# each grid cell synthesizes a rawacf file of single target records in its own temporary directory,
+# runs the fitter on it and compares the fitted gates against the known targets
+
+import numpy as np
+import datetime
+import itertools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from rawacf_generator import rawacf_record, NBEAMS, INTT
+from superdarn_tools import target_catalog, LAMBDA_FIT
+from pydmap_index import datetime_to_epoch
+from fit_compare import fitacf_gates, compare_gates, GATE_DTYPE, COMPARE_FIELDS
+from fit_backends import FIT_BACKENDS, get_backend
+from noise_engine import record_noise_engine
+
+RECORDTIME = datetime.datetime(2015, 1, 1, 0, 0)
+DEF_TRIALS = 32 # records per grid cell
+DEF_NOISE = .1
+DEF_FIT_COMMAND = 'make_fit -new {rawacf} > {fit}'
+
+# grid parameters in sweep order, snr is the target lag 0 power over the noise level in dB
+GRID_PARAMS = ['velocity', 'width', 'snr', 'gate', 'nave']
+
+DEF_GRID = { \
+    'velocity' : [-500, 0, 500], \
+    'width' : [50, 200], \
+    'snr' : [3, 10, 20], \
+    'gate' : [5, 30], \
+    'nave' : [30]}
+
+RESULT_DTYPE = np.dtype([(p, np.float64) for p in GRID_PARAMS] + [ \
+    ('trials', np.int32),\
+    ('matched', np.int32),\
+    ('coverage', np.float64),\
+    ('generate_time', np.float64),\
+    ('fit_time', np.float64)] + \
+    [(f + '_bias', np.float64) for f in COMPARE_FIELDS] + \
+    [(f + '_rms', np.float64) for f in COMPARE_FIELDS])
+
+def grid_cells(grid):
+    ''' returns every combination of the grid values as a list of dicts '''
+    values = [grid[p] for p in GRID_PARAMS]
+    return [dict(zip(GRID_PARAMS, cell)) for cell in itertools.product(*values)]
+
+def synthesize_cell(rawacfname, cell, trials, noise, engine):
+    ''' writes trials records with one target each at the cell parameters, returns the truth as a gate table
+        with p_l as the snr in dB, the scale fitacf reports lag 0 power on '''
+    record = rawacf_record()
+    record.scalars['nave'].setData(int(cell['nave']))
+    power = noise * 10 ** (cell['snr'] / 10.)
+
+    truth = target_catalog(size = trials)
+    truth['rangegate'] = cell['gate']
+    truth['velocity'] = cell['velocity']
+    truth['width'] = cell['width']
+    truth['power'] = power
+
+    with open(rawacfname, 'wb') as f:
+        for trial in range(trials):
+            rtime = RECORDTIME + datetime.timedelta(seconds = trial * INTT)
+            truth['time'][trial] = datetime_to_epoch(rtime)
+            truth['bmnum'][trial] = trial % NBEAMS
+
+            record.vectors['acfd'].data[...] = 0
+            record.vectors['xcfd'].data[...] = 0
+            record.addScatter(cell['gate'], cell['velocity'], cell['width'], power, model = LAMBDA_FIT)
+            record.finalize(engine = engine, noise = noise)
+            record.setTime(rtime)
+            record.scalars['bmnum'].setData(trial % NBEAMS)
+            f.write(record.getBuffer())
+
+    gates = truth.toGates(GATE_DTYPE)
+    gates['p_l'] = cell['snr']
+    return gates
+
+def run_fitter(fitter, rawacfname, fitname):
+    ''' runs fitter on rawacfname, returns the fitted gate table
+        fitter is the name of a registered fit backend, a command template with {rawacf} and {fit} fields writing a fitacf file,
+        or a callable fitter(rawacfname, fitname) (like a fit_backend) that either writes a fitacf file to fitname or returns a gate table '''
+    if fitter in FIT_BACKENDS:
+        fitter = get_backend(fitter)
+
+    if callable(fitter):
+        gates = fitter(rawacfname, fitname)
+        if gates is not None:
+            return gates
+    else:
+        subprocess.check_call(fitter.format(rawacf = rawacfname, fit = fitname), shell = True)
+    return fitacf_gates(fitname)
+
+def benchmark_cell(task):
+    ''' synthesizes, fits and scores one grid cell in its own temporary directory, returns (cellnum, result row) '''
+    cellnum, cell, fitter, trials, noise, seed = task
+    engine = record_noise_engine(seed, cellnum)
+    result = np.zeros(1, dtype = RESULT_DTYPE)[0]
+    for p in GRID_PARAMS:
+        result[p] = cell[p]
+    result['trials'] = trials
+
+    tmpdir = tempfile.mkdtemp(prefix = 'fit_benchmark')
+    try:
+        rawacfname = os.path.join(tmpdir, 'cell.rawacf')
+        fitname = os.path.join(tmpdir, 'cell.fitacf')
+
+        start = time.time()
+        truth = synthesize_cell(rawacfname, cell, trials, noise, engine)
+        result['generate_time'] = time.time() - start
+
+        start = time.time()
+        fitted = run_fitter(fitter, rawacfname, fitname)
+        result['fit_time'] = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+    stats = compare_gates(truth, fitted)
+    result['matched'] = stats['matched']
+    result['coverage'] = stats['coverage']
+    for field in COMPARE_FIELDS:
+        result[field + '_bias'] = stats[field]['bias']
+        result[field + '_rms'] = stats[field]['rms']
+
+    return cellnum, result
+
+def run_benchmark(fitter = DEF_FIT_COMMAND, grid = DEF_GRID, trials = DEF_TRIALS, noise = DEF_NOISE, seed = 0, processes = None):
+    ''' benchmarks fitter over every cell of grid in a pool of processes, returns a RESULT_DTYPE table in grid order
+        callable fitters have to be picklable (module level functions) to reach the workers '''
+    tasks = [(cellnum, cell, fitter, trials, noise, seed) for cellnum, cell in enumerate(grid_cells(grid))]
+    results = np.zeros(len(tasks), dtype = RESULT_DTYPE)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for cellnum, result in pool.imap_unordered(benchmark_cell, tasks):
+            results[cellnum] = result
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+def print_results(results):
+    columns = GRID_PARAMS + ['coverage'] + [f + '_bias' for f in COMPARE_FIELDS] + [f + '_rms' for f in COMPARE_FIELDS] + ['fit_time']
+    print ' '.join('{:>10}'.format(c[:10]) for c in columns)
+    for row in results:
+        print ' '.join('{:10.3f}'.format(row[c]) for c in columns)
+
+def main():
+    # fit backend name or command template and output table name may be given on the command line
+    fitter = sys.argv[1] if len(sys.argv) > 1 else DEF_FIT_COMMAND
+    results = run_benchmark(fitter)
+    print_results(results)
+    if len(sys.argv) > 2:
+        np.save(sys.argv[2], results)
+
+if __name__ == '__main__':
+    main()
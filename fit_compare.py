@@ -0,0 +1,154 @@
+# vectorized comparison of fitted parameters between fit outputs (fitacf, fitlomb or a synthetic truth)
+# every fitted gate of a file becomes a row of a gate table, tables are aligned on (time, beam, channel, gate)
+# and error statistics are computed over all matched gates at once
+
+import numpy as np
+from pydmap_read import dmap_file_reader
+from pydmap_index import record_time
+from dmap_convert import dmap_columnizer, npz_columns, CHUNK_RECORDS, OFFSETS_SUFFIX
+
+FIT_FIELDS = ['v', 'v_e', 'w_l', 'w_l_e', 'p_l', 'nlag']
+
+GATE_DTYPE = np.dtype([ \
+    ('time', np.float64),\
+    ('bmnum', np.int16),\
+    ('channel', np.int16),\
+    ('gate', np.int16),\
+    ('v', np.float32),\
+    ('v_e', np.float32),\
+    ('w_l', np.float32),\
+    ('w_l_e', np.float32),\
+    ('p_l', np.float32),\
+    ('nlag', np.int16)])
+
+# gates are matched on a single int64 key packing time (ms), beam, channel and gate
+KEY_TIME_RESOLUTION = 1e3
+KEY_BEAMS = 1 << 6
+KEY_CHANNELS = 1 << 3
+KEY_GATES = 1 << 12
+
+COMPARE_FIELDS = ['v', 'w_l', 'p_l']
+
+# error histogram bin edges for each compared field
+HIST_BINS = { \
+    'v':np.linspace(-500, 500, 101),\
+    'w_l':np.linspace(-500, 500, 101),\
+    'p_l':np.linspace(-20, 20, 81),\
+    'v_e':np.linspace(-200, 200, 81),\
+    'w_l_e':np.linspace(-200, 200, 81),\
+    'nlag':np.arange(-25, 26)}
+
+def gates_from_columns(columns):
+    ''' builds a gate table from columns in the dmap_convert layout, one row per entry of slist in each record '''
+    if 'slist' not in columns:
+        return np.zeros(0, dtype = GATE_DTYPE)
+
+    counts = np.diff(columns['slist' + OFFSETS_SUFFIX])
+    gates = np.zeros(len(columns['slist']), dtype = GATE_DTYPE)
+    gates['time'] = np.repeat(columns['time'], counts)
+    gates['bmnum'] = np.repeat(columns['bmnum'], counts)
+    if 'channel' in columns:
+        gates['channel'] = np.repeat(columns['channel'], counts)
+    gates['gate'] = columns['slist']
+
+    for field in FIT_FIELDS:
+        if field in columns:
+            if len(columns[field]) != len(gates):
+                raise ValueError('{} is not indexed by slist'.format(field))
+            gates[field] = columns[field]
+
+    return gates
+
+def fitacf_gates(filename, chunk = CHUNK_RECORDS):
+    ''' returns the gate table of every record in a fitacf file '''
+    writer = npz_columns(None)
+    columnizer = dmap_columnizer(writer, fields = ['bmnum', 'channel', 'slist'] + FIT_FIELDS)
+    with dmap_file_reader(filename) as reader:
+        for start in range(0, len(reader), chunk):
+            columnizer.append([reader.readRecord(recnum) for recnum in range(start, min(start + chunk, len(reader)))])
+
+    return gates_from_columns(writer.getColumns())
+
+def fitlomb_gates(filename):
+    ''' returns the gate table of a fitlomb hdf5 file, gates with nlag of zero were not fitted and are left out
+        each record group is expected to carry the record's dmap scalars (time.yr.., bmnum) as attributes '''
+    import h5py
+    tables = []
+    with h5py.File(filename, 'r') as h5f:
+        for name in sorted(h5f.keys()):
+            group = h5f[name]
+            nlag = group['nlag'][...]
+            fitted = np.flatnonzero(nlag > 0)
+
+            gates = np.zeros(len(fitted), dtype = GATE_DTYPE)
+            gates['time'] = record_time(dict(group.attrs))
+            gates['bmnum'] = group.attrs.get('bmnum', -1)
+            gates['channel'] = group.attrs.get('channel', 0)
+            gates['gate'] = fitted
+            for field in FIT_FIELDS:
+                gates[field] = group[field][...][fitted]
+            tables.append(gates)
+
+    if not tables:
+        return np.zeros(0, dtype = GATE_DTYPE)
+    return np.concatenate(tables)
+
+def gate_keys(gates):
+    ''' packs the time, beam, channel and gate of each row into an int64 key '''
+    if len(gates) and (gates['bmnum'].max() >= KEY_BEAMS or gates['gate'].max() >= KEY_GATES or \
+            gates['channel'].min() < 0 or gates['channel'].max() >= KEY_CHANNELS):
+        raise ValueError('beam, channel or gate number out of range for a gate key')
+    times = np.round(gates['time'] * KEY_TIME_RESOLUTION).astype(np.int64)
+    return ((times * KEY_BEAMS + gates['bmnum']) * KEY_CHANNELS + gates['channel']) * KEY_GATES + gates['gate']
+
+def align_gates(reference, test):
+    ''' matches rows of two gate tables on time, beam, channel and gate, returns the matching indices into each table '''
+    rkeys = gate_keys(reference)
+    tkeys = gate_keys(test)
+    if len(np.unique(rkeys)) != len(rkeys) or len(np.unique(tkeys)) != len(tkeys):
+        raise ValueError('gate tables hold the same time, beam, channel and gate more than once')
+
+    keys, ridx, tidx = np.intersect1d(rkeys, tkeys, assume_unique = True, return_indices = True)
+    return ridx, tidx
+
+def compare_gates(reference, test, fields = COMPARE_FIELDS, groupby = None):
+    ''' computes the error of test against reference over all matched gates
+        returns a dict with the number of gates in each table and matched, coverage (matched fraction of reference),
+        and for each field a dict of bias, rms and std of the error and its histogram (counts, edges)
+        if groupby names a gate table column, bias, rms and count are also given for each value of it '''
+    ridx, tidx = align_gates(reference, test)
+    matched = len(ridx)
+
+    stats = { \
+        'reference':len(reference),\
+        'test':len(test),\
+        'matched':matched,\
+        'coverage':matched / float(len(reference)) if len(reference) else np.nan}
+
+    if groupby is not None:
+        groups, group_idx = np.unique(reference[groupby][ridx], return_inverse = True)
+        group_counts = np.bincount(group_idx, minlength = len(groups))
+
+    for field in fields:
+        err = test[field][tidx].astype(np.float64) - reference[field][ridx]
+        fstats = {}
+        fstats['bias'] = err.mean() if matched else np.nan
+        fstats['rms'] = np.sqrt(np.mean(err ** 2)) if matched else np.nan
+        fstats['std'] = err.std() if matched else np.nan
+        fstats['hist'] = np.histogram(err, bins = HIST_BINS.get(field, 100))
+
+        if groupby is not None:
+            nonzero = np.maximum(group_counts, 1)
+            fstats['groups'] = groups
+            fstats['group_count'] = group_counts
+            fstats['group_bias'] = np.bincount(group_idx, weights = err, minlength = len(groups)) / nonzero
+            fstats['group_rms'] = np.sqrt(np.bincount(group_idx, weights = err ** 2, minlength = len(groups)) / nonzero)
+
+        stats[field] = fstats
+
+    return stats
+
+def print_comparison(stats, fields = COMPARE_FIELDS):
+    print 'matched {} of {} reference gates ({:.1%} coverage), {} test gates'.format(stats['matched'], stats['reference'], stats['coverage'], stats['test'])
+    for field in fields:
+        print '{}: bias {:.3f}, rms {:.3f}, std {:.3f}'.format(field, stats[field]['bias'], stats[field]['rms'], stats[field]['std'])
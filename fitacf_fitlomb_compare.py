@@ -4,21 +4,15 @@
 # process file with fitacf and fitlomb
 # compare output..
 
-import os
 import sys
 import pdb
 import datetime
-import h5py
-import pydarn.sdio as sdio
 
-from multiprocessing import Manager
 from rawacf_generator import rawacf_record
+from noise_engine import record_noise_engine
 from superdarn_tools import *
-
-sys.path.append('../SuperDARN_FitLOMB')
-import lagstate
-from cuda_bayes import BayesGPU
-from pydarncuda_fitlomb import CULombFit
+from fit_compare import fitacf_gates, fitlomb_gates, compare_gates, print_comparison
+from fit_backends import make_fit_backend, cuda_lomb_backend
 
 SANDBOX = '/home/radar/repos/SuperDARN_pydmap_write/sandbox'
 ACF_NAME = '20150101.0000.00.tst'
@@ -30,113 +24,71 @@ RADAR = 'tst'
 RECORDTIME = datetime.datetime(2015, 1, 1, 0, 0)
 DEF_NOISE = .1
 
-C = 3e8
-MAX_TFREQ = 16e6
-LOMB_PASSES = 1
-NFREQS = 256
-NALFS = 256
-FWHM_TO_SIGMA = 2.355 # conversion of fwhm to std deviation, assuming gaussian
-MAX_V = 2000 # m/s, max velocity (doppler shift) to include in lomb
-MAX_W = 1200 # m/s, max spectral width to include in lomb 
-
 
-# synthesizes a rawacf file with velocity and spectral width at gates rgates 
-def generate_rawacf(rawacfname, targets = [], noise = DEF_NOISE):
+# synthesizes a rawacf file with scatter from a target_catalog
+def generate_rawacf(rawacfname, targets = target_catalog(), noise = DEF_NOISE):
     rawacf = rawacf_record(filename = rawacfname)
 
-    for target in targets:
-        rawacf.addTarget(target)
-    
+    rawacf.addTarget(targets)
     rawacf.generateScatter()
-    rawacf.applyNoise(noise)
-    rawacf.calcPwr0()
+    rawacf.finalize(engine = record_noise_engine(0), noise = noise)
     rawacf.setTime(RECORDTIME) 
     rawacf.write()
     rawacf.close()
 
 # generates a fitacf file fitacfname from rawacf file rawacfname
 def generate_fitacf(rawacfname, fitacfname):
-    cmd = 'make_fit -new {} > {}'.format(rawacfname, fitacfname)
-    os.system(cmd)
+    make_fit_backend().fit(rawacfname, fitacfname)
 
 # generates a fitlomb file fitacfname from rawacf file rawacfname
 def generate_fitlomb(rawacfname, fitlombname):
-    os.environ['DAVIT_LOCALDIR'] = SANDBOX
-    os.environ['DAVIT_DIRFORMAT'] = '%(dirtree)s/'
-    radar = RADAR
-    manager = Manager()
-    lock = manager.Lock()
-    
-    stime = RECORDTIME
-    etime = None
-    
-    hdf5file = h5py.File(fitlombname, 'w')
-
-    myPtr = sdio.radDataOpen(stime,radar,eTime=etime,channel=None,bmnum=None,cp=None,fileType='rawacf',filtered=False, src='local', noCache = True)
-    drec = sdio.radDataReadRec(myPtr)
-
-    amax = np.ceil((np.pi * 2 * MAX_TFREQ * MAX_W) / C)
-    fmax = np.ceil(MAX_V * 2 * MAX_TFREQ / C)
-    freqs = np.linspace(-fmax,fmax, NFREQS)
-    alfs = np.linspace(0, amax, NALFS)
-
-    fit = CULombFit(drec)
-    gpu_lambda = BayesGPU(fit.lags, freqs, alfs, fit.nrang, LAMBDA_FIT)
-    txlag_cache = lagstate.good_lags_txsamples(fit)
-    fit.SetBadlags(txlag_cache = txlag_cache)
-    fit.CudaProcessPulse(gpu_lambda)
-    fit.CudaCopyPeaks(gpu_lambda)
-    fit.WriteLSSFit(hdf5file)
-    hdf5file.close()
-
-# parse fitacf, returns a list of targets at ranges rgates
+    cuda_lomb_backend(SANDBOX, RADAR, RECORDTIME).fit(rawacfname, fitlombname)
+
+# parse fitacf, returns a target_catalog of the fitted parameters at ranges rgates
 def parse_fitacf(fitacfname, rgates):
-    dumpstr = get_dmapdumpstring()
-    scandata = parse_dmapdumpstring(dumpstr)
-    targets = []
-    for rgate in rgates:
-        if rgate in scandata['slist']:
-            sidx = np.nonzero(scandata['slist'] == rgate)[0][0]
-            v = scandata['v'][sidx]
-            w_l = scandata['w_l'][sidx]
-            p_l = scandata['p_l'][sidx]
-            v_e = scandata['v_e'][sidx]
-            w_l_e = scandata['w_l_e'][sidx]
-            nlag = scandata['nlag'][sidx]
-
-            targets.append(target(rangegate = rgate, velocity = v, width = w_l, power = p_l, v_e = v_e, w_e = w_l_e, nlag = nlag))
-
-        else:
-            print('scatter not found on range gate {}'.format(rgate))
-            targets.append(target(rangegate = rgate, nlag = 0))
+    scandata = read_dmap_scandata(fitacfname)
+    rgates = np.asarray(rgates)
+    targets = target_catalog(size = len(rgates))
+    targets['rangegate'] = rgates
+
+    slist = scandata.get('slist', np.zeros(0, dtype = np.int16))
+    found = np.in1d(rgates, slist)
+    sidx = np.searchsorted(slist, rgates[found])
+    for field, fit_field in TARGET_FIT_FIELDS:
+        targets[field][found] = scandata[fit_field][sidx]
+
+    for rgate in rgates[~found]:
+        print('scatter not found on range gate {}'.format(rgate))
 
     return targets
 
-# parse fitlomb, return a list of targets at ranges rgates
+# parse fitlomb, return a target_catalog of the fitted parameters at ranges rgates
 def parse_fitlomb(fitlombname, rgates):
+    import h5py
     h5f = h5py.File(fitlombname, 'r')
     beamgrp = h5f[h5f.keys()[0]]
-    targets = []
+    rgates = np.asarray(rgates)
+    targets = target_catalog(size = len(rgates))
+    targets['rangegate'] = rgates
 
-    v = beamgrp['v'][...]
-    v_e = beamgrp['v_e'][...]
-    p_l =  beamgrp['p_l'][...]
-    w_l =  beamgrp['w_l'][...]
-    w_l_e = beamgrp['w_l_e'][...]
-    nlag = beamgrp['nlag'][...]
-    for rgate in rgates:
-        targets.append(target(rangegate = rgate, velocity = v[rgate], width = w_l[rgate], power = p_l[rgate], v_e = v_e[rgate], w_e = w_l_e[rgate], nlag = nlag[rgate]))
+    for field, fit_field in TARGET_FIT_FIELDS:
+        targets[field] = beamgrp[fit_field][...][rgates]
 
+    h5f.close()
     return targets
 
+# compares every fitted gate of every record in a fitlomb file against a fitacf file
+def compare_fits(fitacfname, fitlombname, groupby = None):
+    stats = compare_gates(fitacf_gates(fitacfname), fitlomb_gates(fitlombname), groupby = groupby)
+    print_comparison(stats)
+    return stats
+
 def test_fitacf():
     rawacf_name = SANDBOX + '/' + ACF_NAME + RAWACF_EXT
     fitacf_name = SANDBOX + '/' + ACF_NAME + FITACF_EXT
-    synthetic_targets = []
-    t = target(rangegate = 5, velocity = 500, width = 200, power = 1)
-    synthetic_targets.append(t)
+    synthetic_targets = target_catalog.fromTargets([target(rangegate = 5, velocity = 500, width = 200, power = 1)])
 
-    gates = [t.rangegate for t in synthetic_targets]
+    gates = synthetic_targets['rangegate']
     generate_rawacf(rawacf_name, targets = synthetic_targets, noise = .1)
     generate_fitacf(rawacf_name, fitacf_name)
     fitacf_targets = parse_fitacf(fitacf_name, gates)
@@ -156,13 +108,12 @@ def main():
     fitlomb_name = SANDBOX + '/' + ACF_NAME + HDF5_EXT
 
     print 'creating targets...'
-    synthetic_targets = []
-    synthetic_targets.append(target(rangegate = 5, velocity = 500, width = 200, power = 1))
-    synthetic_targets.append(target(rangegate = 6, velocity = 300, width = 100, power = 1))
-    synthetic_targets.append(target(rangegate = 7, velocity = 000, width = 000, power = 1))
+    synthetic_targets = target_catalog.fromTargets([ \
+            target(rangegate = 5, velocity = 500, width = 200, power = 1),\
+            target(rangegate = 6, velocity = 300, width = 100, power = 1),\
+            target(rangegate = 7, velocity = 000, width = 000, power = 1)])
 
-
-    gates = [t.rangegate for t in synthetic_targets]
+    gates = synthetic_targets['rangegate']
     
     print 'creating rawacf...'
     generate_rawacf(rawacf_name, targets = synthetic_targets, noise = .1)
@@ -188,5 +139,8 @@ def main():
     for t in fitlomb_targets:
         print t
 
+    print 'fitlomb against fitacf:'
+    compare_fits(fitacf_name, fitlomb_name)
+
 if __name__ == '__main__':
     main()
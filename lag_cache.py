@@ -0,0 +1,85 @@
+# per pulse sequence lag tables shared by the generator and the fitters
+# lag times, lag pulse pairs and transmitter overlap bad lags only depend on the pulse sequence and sampling,
+# which are constant over millions of records, so they are derived once and kept in a small lru cache
+
+import numpy as np
+from collections import OrderedDict
+from superdarn_tools import calc_lag_times
+
+LAG_CACHE_SIZE = 64 # pulse sequences kept
+TX_BLANK_TAIL = 100 # us, receiver recovery after a pulse, samples this long after the end of a pulse are still bad (as in rst)
+
+class lru_cache(object):
+    ''' dictionary holding at most maxsize entries, evicting the least recently used '''
+    def __init__(self, maxsize = LAG_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        ''' returns the entry for key and marks it as most recently used, None if it is not cached '''
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class lag_table(object):
+    ''' lags of a pulse sequence
+        lagt: lag times (s), lagnums: lags in units of mpinc, pairs: (mplgs, 2) indices into ptab of the pulses making each lag,
+        badlags: (nrang, mplgs) mask of the lags of each gate with a sample blanked by a transmitted pulse '''
+    def __init__(self, ptab, ltab, mplgs, mpinc, smsep, txpl, lagfr, nrang):
+        ptab = np.asarray(ptab, dtype = np.int64)
+        ltab = np.asarray(ltab, dtype = np.int64)[0:mplgs]
+
+        self.lagt = calc_lag_times(ltab, mplgs, mpinc)
+        self.lagnums = np.abs(ltab[:,1] - ltab[:,0])
+
+        order = np.argsort(ptab)
+        self.pairs = order[np.minimum(np.searchsorted(ptab, ltab, sorter = order), len(ptab) - 1)]
+        self.pairs[ptab[self.pairs] != ltab] = -1 # lags made from pulses not in ptab
+
+        # sample times (us after the first pulse) of both pulses of every lag at every gate, (nrang, mplgs, 2)
+        samples = ltab * mpinc + lagfr + np.arange(nrang).reshape(-1, 1, 1) * smsep
+
+        # a sample is blanked if it lands within a transmitted pulse or the receiver recovery after it
+        pulses = ptab * mpinc
+        starts = pulses - txpl / 2.
+        ends = pulses + txpl + TX_BLANK_TAIL
+        blanked = (samples[...,np.newaxis] >= starts) & (samples[...,np.newaxis] <= ends)
+        self.badlags = blanked.any(axis = 3).any(axis = 2)
+
+    def goodLags(self, gates = None):
+        ''' returns the good lag mask of gates (all gates by default), (ngates, mplgs) '''
+        if gates is None:
+            return ~self.badlags
+        return ~self.badlags[np.asarray(gates)]
+
+_lag_tables = lru_cache()
+
+def get_lag_table(ptab, ltab, mplgs, mpinc, smsep, txpl, lagfr, nrang):
+    ''' returns the lag_table of a pulse sequence and sampling from the shared cache, building it if needed '''
+    key = (np.asarray(ptab, dtype = np.int64).tobytes(), np.asarray(ltab, dtype = np.int64)[0:mplgs].tobytes(), \
+            int(mplgs), int(mpinc), int(smsep), int(txpl), int(lagfr), int(nrang))
+    table = _lag_tables.get(key)
+    if table is None:
+        table = lag_table(ptab, ltab, mplgs, mpinc, smsep, txpl, lagfr, nrang)
+        _lag_tables.put(key, table)
+    return table
+
+def record_lag_table(scalars, vectors):
+    ''' returns the lag_table of a decoded record, scalars and vectors as returned by the readers '''
+    return get_lag_table(vectors['ptab'], vectors['ltab'], scalars['mplgs'], scalars['mpinc'], \
+            scalars['smsep'], scalars['txpl'], scalars['lagfr'], scalars['nrang'])
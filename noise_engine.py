@@ -0,0 +1,96 @@
+# noise and clutter synthesis for rawacf acfd/xcfd buffers
+# noise is drawn from a per record (or per scan) random stream straight into a reusable scratch buffer
+# and added in place, buffers may be a single record (nrang, mplgs, 2) or a stack of records (nrec, nrang, mplgs, 2)
+
+import numpy as np
+from superdarn_tools import target_catalog, make_rng, C
+
+ISAMP = 0
+QSAMP = 1
+
+G = 9.81 # m/s^2
+
+# ground scatter, slow and narrow scatter over a band of gates
+DEF_GROUND_PARAMS = { \
+    'gates' : (20, 40), \
+    'velocity_std' : 20, \
+    'width' : (0, 30), \
+    'power' : (.5, 1)}
+
+# sea clutter, first order bragg lines from ocean waves of half the radar wavelength
+DEF_SEA_PARAMS = { \
+    'gates' : (10, 75), \
+    'power' : (.2, .5), \
+    'ratio' : (.1, 1), \
+    'current_std' : .5, \
+    'width' : (0, 5)}
+
+def bragg_velocity(tfreq):
+    ''' returns the phase velocity (m/s) of the ocean waves bragg scattering a radar at tfreq (kHz) '''
+    return np.sqrt(G * C / (4 * np.pi * tfreq * 1000.))
+
+class noise_engine(object):
+    ''' adds receiver noise with the statistics of acf estimates averaged over nave pulse sequences
+        for white noise of power noise per sample, the lag 0 acf power has mean noise and standard deviation noise / sqrt(nave)
+        with no imaginary part, every other lag (and every lag of xcfd, correlating independent receivers) is zero mean
+        with standard deviation noise / sqrt(2 nave) on each component '''
+    def __init__(self, rng):
+        self.rng = rng
+        self.scratch = np.empty(0, dtype = np.float32)
+
+    def _standardNormal(self, shape):
+        ''' returns a scratch array of standard normal draws, reusing the buffer between calls '''
+        size = int(np.prod(shape))
+        if self.scratch.size < size:
+            self.scratch = np.empty(size, dtype = np.float32)
+        out = self.scratch[:size].reshape(shape)
+
+        if hasattr(self.rng, 'integers'):
+            self.rng.standard_normal(out = out, dtype = np.float32)
+        else:
+            out[...] = self.rng.standard_normal(shape)
+        return out
+
+    def addNoise(self, acfd, noise, nave, cross = False):
+        ''' adds noise of power noise to acfd in place, cross for xcfd which has no lag 0 power bias '''
+        draws = self._standardNormal(acfd.shape)
+        draws *= noise / np.sqrt(2. * nave)
+
+        if not cross:
+            # lag 0 power is real and positive, its spread is sqrt(2) larger than a single component of the other lags
+            draws[...,0,ISAMP] *= np.sqrt(2.)
+            draws[...,0,ISAMP] += noise
+            draws[...,0,QSAMP] = 0
+
+        acfd += draws
+
+    def groundScatter(self, nrang, params = DEF_GROUND_PARAMS):
+        ''' returns a target_catalog of ground scatter, a target of near zero velocity and narrow width at every gate of the band '''
+        gates = np.arange(params['gates'][0], min(params['gates'][1], nrang))
+        catalog = target_catalog(size = len(gates))
+        catalog['rangegate'] = gates
+        catalog['velocity'] = self.rng.normal(0, params['velocity_std'], len(gates))
+        catalog['width'] = self.rng.uniform(params['width'][0], params['width'][1], len(gates))
+        catalog['power'] = self.rng.uniform(params['power'][0], params['power'][1], len(gates))
+        return catalog
+
+    def seaClutter(self, nrang, tfreq, params = DEF_SEA_PARAMS):
+        ''' returns a target_catalog of sea clutter, an approaching and a receding bragg line at every gate of the band
+            shifted by a surface current, the receding line is weaker by a per gate ratio '''
+        gates = np.arange(params['gates'][0], min(params['gates'][1], nrang))
+        ngates = len(gates)
+        vb = bragg_velocity(tfreq)
+        current = self.rng.normal(0, params['current_std'], ngates)
+        power = self.rng.uniform(params['power'][0], params['power'][1], ngates)
+        ratio = self.rng.uniform(params['ratio'][0], params['ratio'][1], ngates)
+
+        catalog = target_catalog(size = 2 * ngates)
+        catalog['rangegate'] = np.concatenate([gates, gates])
+        catalog['velocity'] = np.concatenate([vb + current, -vb + current])
+        catalog['width'] = self.rng.uniform(params['width'][0], params['width'][1], 2 * ngates)
+        catalog['power'] = np.concatenate([power, power * ratio])
+        return catalog
+
+def record_noise_engine(seed, *streams):
+    ''' returns a noise_engine drawing from the stream of (seed, streams..), e.g. (seed, scan, beam) for reproducible records '''
+    return noise_engine(make_rng(seed, *streams))
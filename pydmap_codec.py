@@ -0,0 +1,314 @@
+# dmap type codes and record decoding shared by the reader and the writer
+# every dmap type code maps to a numpy type and a precompiled little endian struct
+
+import numpy as np
+import struct
+
+DATACODE = 33
+RST_DATACODE = 65537 # 0x00010001, used by rst and the realtime servers
+DATACODES = (DATACODE, RST_DATACODE)
+DATACHAR = 1
+DATASHORT = 2
+DATAINT = 3
+DATAFLOAT = 4
+DATADOUBLE = 8
+DATASTRING = 9
+DATALONG = 10
+DATAUCHAR = 16
+DATAUSHORT = 17
+DATAUINT = 18
+DATAULONG = 19
+DATAMAP = 255
+NULL = chr(0)
+
+# fixed size types, dmap type code: (numpy type, struct format)
+FIXED_TYPES = { \
+    DATACHAR:(np.int8, 'b'),\
+    DATASHORT:(np.int16, 'h'),\
+    DATAINT:(np.int32, 'i'),\
+    DATAFLOAT:(np.float32, 'f'),\
+    DATADOUBLE:(np.float64, 'd'),\
+    DATALONG:(np.int64, 'q'),\
+    DATAUCHAR:(np.uint8, 'B'),\
+    DATAUSHORT:(np.uint16, 'H'),\
+    DATAUINT:(np.uint32, 'I'),\
+    DATAULONG:(np.uint64, 'Q')}
+
+# dmap type code -> numpy type, strings decode to str and maps to (scalars, vectors)
+CODE_DTYPES = dict((code, FIXED_TYPES[code][0]) for code in FIXED_TYPES)
+CODE_DTYPES[DATASTRING] = str
+CODE_DTYPES[DATAMAP] = dict
+
+# dmap type code -> precompiled struct and little endian numpy dtype for decoding
+CODE_STRUCTS = dict((code, struct.Struct('<' + FIXED_TYPES[code][1])) for code in FIXED_TYPES)
+CODE_NPDTYPES = dict((code, np.dtype(FIXED_TYPES[code][0]).newbyteorder('<')) for code in FIXED_TYPES)
+
+# numpy type -> dmap type code for encoding
+# rst stores 8 bit fields (revision numbers, qflg, gflg..) as char, so uint8 is written as DATACHAR
+DTYPE_CODES = { \
+    np.int8:DATACHAR,\
+    np.uint8:DATACHAR,\
+    np.int16:DATASHORT,\
+    np.int32:DATAINT,\
+    np.float32:DATAFLOAT,\
+    np.float64:DATADOUBLE,\
+    np.int64:DATALONG,\
+    np.uint16:DATAUSHORT,\
+    np.uint32:DATAUINT,\
+    np.uint64:DATAULONG,\
+    str:DATASTRING}
+
+# numpy type -> precompiled struct for encoding scalars and little endian numpy dtype for encoding vectors
+DTYPE_STRUCTS = dict((dtype, CODE_STRUCTS[DTYPE_CODES[dtype]]) for dtype in DTYPE_CODES if dtype != str)
+DTYPE_NPDTYPES = dict((dtype, np.dtype(dtype).newbyteorder('<')) for dtype in DTYPE_CODES if dtype != str)
+
+HEADER_STRUCT = struct.Struct('<iiii')
+INT_STRUCT = struct.Struct('<i')
+CODE_STRUCT = struct.Struct('<B')
+
+# limits used to tell records from garbage when resynchronizing
+MAX_RECORD_SIZE = 1 << 26
+MAX_NAME_LEN = 128
+MAX_DIMS = 8
+MIN_SCALAR_SIZE = 4 # one character name, null, type code and a char
+MIN_VECTOR_SIZE = 11 # one character name, null, type code, ndims and one dim
+NAME_CHARS = ''.join(chr(c) for c in range(33, 127))
+
+def _parse_string(buf, pos):
+    ''' returns the null terminated string at pos and the position after it '''
+    end = buf.find(NULL, pos)
+    return bytes(buf[pos:end]), end + 1
+
+def _parse_name(buf, pos):
+    ''' returns the name and type code of the variable at pos and the position of its payload '''
+    end = buf.find(NULL, pos)
+    return bytes(buf[pos:end]), CODE_STRUCT.unpack_from(buf, end + 1)[0], end + 2
+
+def parse_record(buf, offset = 0, skip_vectors = False):
+    ''' decodes the dmap record starting at offset in buf (anything exposing the buffer interface)
+        returns scalars, vectors and the offset just past the record, vectors is left empty if skip_vectors
+        vectors are numpy views into buf, so buf must outlive them and must not be modified '''
+    scalars = {}
+    vectors = {}
+
+    datacode, sze, snum, anum = HEADER_STRUCT.unpack_from(buf, offset)
+    pos = offset + HEADER_STRUCT.size
+
+    # read in scalars
+    for s in range(snum):
+        name, code, pos = _parse_name(buf, pos)
+        if code in CODE_STRUCTS:
+            scalars[name] = CODE_DTYPES[code](CODE_STRUCTS[code].unpack_from(buf, pos)[0])
+            pos += CODE_STRUCTS[code].size
+        elif code == DATASTRING:
+            scalars[name], pos = _parse_string(buf, pos)
+        elif code == DATAMAP:
+            submap_scalars, submap_vectors, pos = parse_record(buf, pos)
+            scalars[name] = (submap_scalars, submap_vectors)
+        else:
+            raise ValueError('unknown dmap type code {} for scalar {}'.format(code, name))
+
+    if skip_vectors:
+        return scalars, vectors, offset + sze
+
+    # read in vectors
+    for a in range(anum):
+        name, code, pos = _parse_name(buf, pos)
+        ndims = INT_STRUCT.unpack_from(buf, pos)[0]
+        dims = struct.unpack_from('<%di' % ndims, buf, pos + INT_STRUCT.size)
+        pos += INT_STRUCT.size * (ndims + 1)
+        count = int(np.prod(dims))
+
+        if code in CODE_NPDTYPES:
+            payload = np.frombuffer(buf, dtype = CODE_NPDTYPES[code], count = count, offset = pos)
+            pos += payload.nbytes
+        elif code == DATASTRING or code == DATAMAP:
+            payload = np.empty(count, dtype = object)
+            for i in range(count):
+                if code == DATASTRING:
+                    payload[i], pos = _parse_string(buf, pos)
+                else:
+                    submap_scalars, submap_vectors, pos = parse_record(buf, pos)
+                    payload[i] = (submap_scalars, submap_vectors)
+        else:
+            raise ValueError('unknown dmap type code {} for vector {}'.format(code, name))
+
+        if ndims > 1:
+            payload = np.reshape(payload, dims[::-1])
+        vectors[name] = payload
+
+    return scalars, vectors, offset + sze
+
+def field_extent(buf, pos, vector):
+    ''' locates the field starting at pos without decoding its payload
+        returns name, type code, dims as stored (reversed from the numpy shape, None for scalars), payload offset and end offset '''
+    name, code, pos = _parse_name(buf, pos)
+    dims = None
+    count = 1
+    if vector:
+        ndims = INT_STRUCT.unpack_from(buf, pos)[0]
+        dims = struct.unpack_from('<%di' % ndims, buf, pos + INT_STRUCT.size)
+        pos += INT_STRUCT.size * (ndims + 1)
+        count = int(np.prod(dims))
+
+    payload = pos
+    if code in CODE_STRUCTS:
+        pos += count * CODE_STRUCTS[code].size
+    elif code == DATASTRING:
+        for i in range(count):
+            pos = buf.find(NULL, pos) + 1
+    elif code == DATAMAP:
+        for i in range(count):
+            pos += HEADER_STRUCT.unpack_from(buf, pos)[1]
+    else:
+        raise ValueError('unknown dmap type code {} for field {}'.format(code, name))
+
+    return name, code, dims, payload, pos
+
+def field_layout(buf, offset = 0):
+    ''' locates the top level fields of the record at offset in buf, nested maps are skipped whole
+        returns a dict of name -> (start, payload, end, code, dims) with the offsets of the field, of its payload and just past it '''
+    layout = {}
+    datacode, sze, snum, anum = HEADER_STRUCT.unpack_from(buf, offset)
+    pos = offset + HEADER_STRUCT.size
+
+    for field in range(snum + anum):
+        start = pos
+        name, code, dims, payload, pos = field_extent(buf, pos, field >= snum)
+        layout[name] = (start, payload, pos, code, dims)
+
+    return layout
+
+def encode_field(name, code, value, vector = False):
+    ''' encodes a scalar or vector field, name, type code, dims for vectors and payload, returns the bytes '''
+    if code == DATAMAP:
+        raise ValueError('can\'t encode map field {}'.format(name))
+
+    if vector:
+        value = np.atleast_1d(np.asarray(value, dtype = object if code == DATASTRING else CODE_NPDTYPES[code]))
+        dims = value.shape[::-1]
+        header = name + NULL + CODE_STRUCT.pack(code) + struct.pack('<%di' % (len(dims) + 1), len(dims), *dims)
+    else:
+        header = name + NULL + CODE_STRUCT.pack(code)
+
+    if code == DATASTRING:
+        strings = value.ravel() if vector else [value]
+        return header + ''.join(str(v) + NULL for v in strings)
+    return header + np.asarray(value, dtype = CODE_NPDTYPES[code]).tobytes()
+
+class _incomplete_record(Exception):
+    pass
+
+class _corrupt_record(Exception):
+    pass
+
+def _walk_record(buf, offset, end):
+    ''' walks the fields of the record at offset without decoding them, returns the offset after the record
+        raises _incomplete_record if the record runs past end and _corrupt_record if it is inconsistent '''
+    if offset + HEADER_STRUCT.size > end:
+        raise _incomplete_record
+    datacode, sze, snum, anum = HEADER_STRUCT.unpack_from(buf, offset)
+    if datacode not in DATACODES or sze > MAX_RECORD_SIZE or snum < 0 or anum < 0:
+        raise _corrupt_record
+    if HEADER_STRUCT.size + snum * MIN_SCALAR_SIZE + anum * MIN_VECTOR_SIZE > sze:
+        raise _corrupt_record
+
+    limit = offset + sze
+    avail = min(end, limit)
+
+    def need(pos, nbytes):
+        if pos + nbytes > limit:
+            raise _corrupt_record
+        if pos + nbytes > avail:
+            raise _incomplete_record
+
+    def skip_string(pos):
+        nul = buf.find(NULL, pos, avail)
+        if nul < 0:
+            need(pos, avail - pos + 1)
+        return nul + 1
+
+    pos = offset + HEADER_STRUCT.size
+    for field in range(snum + anum):
+        nul = buf.find(NULL, pos, min(avail, pos + MAX_NAME_LEN + 1))
+        if nul < 0:
+            if pos + MAX_NAME_LEN < avail:
+                raise _corrupt_record
+            need(pos, avail - pos + 1)
+        if nul == pos or bytes(buf[pos:nul]).translate(None, NAME_CHARS):
+            raise _corrupt_record
+
+        need(nul + 1, 1)
+        code = CODE_STRUCT.unpack_from(buf, nul + 1)[0]
+        if code not in CODE_DTYPES:
+            raise _corrupt_record
+        pos = nul + 2
+
+        count = 1
+        if field >= snum:
+            need(pos, INT_STRUCT.size)
+            ndims = INT_STRUCT.unpack_from(buf, pos)[0]
+            if not 0 < ndims <= MAX_DIMS:
+                raise _corrupt_record
+            need(pos, INT_STRUCT.size * (ndims + 1))
+            dims = struct.unpack_from('<%di' % ndims, buf, pos + INT_STRUCT.size)
+            if min(dims) < 0:
+                raise _corrupt_record
+            count = int(np.prod(dims))
+            pos += INT_STRUCT.size * (ndims + 1)
+
+        if code in CODE_STRUCTS:
+            need(pos, count * CODE_STRUCTS[code].size)
+            pos += count * CODE_STRUCTS[code].size
+        else:
+            for i in range(count):
+                if code == DATASTRING:
+                    pos = skip_string(pos)
+                else:
+                    need(pos, HEADER_STRUCT.size)
+                    need(pos, HEADER_STRUCT.unpack_from(buf, pos)[1])
+                    pos = _walk_record(buf, pos, avail)
+
+    if pos != limit:
+        raise _corrupt_record
+    return limit
+
+def check_record(buf, offset, end):
+    ''' checks that the record at offset in buf is consistent, looking only at the bytes before end
+        returns True if it is complete and every field checks out, None if it checks out
+        as far as it goes but runs past end, and False if it can't be a record '''
+    try:
+        _walk_record(buf, offset, end)
+        return True
+    except _incomplete_record:
+        return None
+    except (_corrupt_record, struct.error):
+        return False
+
+def find_record(buf, start = 0, end = None):
+    ''' finds the first offset in buf[start:end] holding a record that passes check_record,
+        candidate headers are located with a vectorized search for the datacodes at every byte offset
+        returns the offset and True if the record is complete or None if it runs past end,
+        if nothing is found returns the offset of the last few bytes, which may start a header, and None '''
+    if end is None:
+        end = len(buf)
+
+    # in sync streams and files have a record right at start
+    status = check_record(buf, start, end)
+    if status is not False:
+        return start, status
+
+    if end - start > INT_STRUCT.size:
+        b = np.frombuffer(buf, dtype = np.uint8, count = end - start, offset = start).astype(np.uint32)
+        codes = b[:-3] | (b[1:-2] << 8) | (b[2:-1] << 16) | (b[3:] << 24)
+        candidates = codes == DATACODES[0]
+        for datacode in DATACODES[1:]:
+            candidates |= codes == datacode
+
+        for candidate in np.flatnonzero(candidates[1:]) + 1:
+            status = check_record(buf, start + candidate, end)
+            if status is not False:
+                return start + candidate, status
+
+    return max(start, end - INT_STRUCT.size + 1), None
+
@@ -0,0 +1,125 @@
+# persistent sidecar index of record offsets, times, beams and channels for dmap files
+# the index is stored next to the dmap file and rebuilt when the file size or mtime changes
+
+import numpy as np
+import os
+import sys
+import calendar
+import datetime
+from pydmap_read import dmap_file_reader
+
+INDEX_EXT = '.idx.npz'
+INDEX_VERSION = 1
+
+INDEX_DTYPE = np.dtype([ \
+    ('offset', np.int64),\
+    ('sze', np.int64),\
+    ('time', np.float64),\
+    ('bmnum', np.int16),\
+    ('channel', np.int16),\
+    ('cp', np.int16),\
+    ('scan', np.int16)])
+
+TIME_FIELDS = ['time.yr', 'time.mo', 'time.dy', 'time.hr', 'time.mt', 'time.sc']
+INDEX_SCALARS = ['bmnum', 'channel', 'cp', 'scan']
+
+def datetime_to_epoch(dt):
+    ''' converts a (utc) datetime to seconds since the unix epoch '''
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+def record_time(scalars):
+    ''' returns the time of a decoded record in seconds since the unix epoch, nan if it has no time or an invalid one
+        (like the zeroed time fields of records written without setTime) '''
+    try:
+        dt = datetime.datetime(*[int(scalars[t]) for t in TIME_FIELDS])
+    except (KeyError, ValueError):
+        return np.nan
+    return datetime_to_epoch(dt) + int(scalars.get('time.us', 0)) / 1e6
+
+class dmap_index(object):
+    ''' record number -> offset, time and beam/channel/cp/scan index for a dmap file '''
+    def __init__(self, filename, rebuild = False, save = True):
+        self.filename = filename
+        self.indexname = filename + INDEX_EXT
+
+        stat = os.stat(filename)
+        self.stamp = np.array([INDEX_VERSION, stat.st_size, stat.st_mtime], dtype = np.float64)
+
+        self.records = None
+        if not rebuild:
+            self.records = self._load()
+
+        if self.records is None:
+            self.records = self._build()
+            if save:
+                self._save()
+
+    def _load(self):
+        ''' returns the saved index, or None if it is missing or stale '''
+        if not os.path.exists(self.indexname):
+            return None
+
+        try:
+            saved = np.load(self.indexname)
+            if not np.array_equal(saved['stamp'], self.stamp):
+                return None
+            return saved['records']
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def _save(self):
+        tmpname = self.indexname + '.tmp'
+        try:
+            with open(tmpname, 'wb') as f:
+                np.savez(f, stamp = self.stamp, records = self.records)
+            os.rename(tmpname, self.indexname)
+        except (IOError, OSError):
+            print >> sys.stderr, 'unable to save index for {}'.format(self.filename)
+
+    def _build(self):
+        ''' scans the file headers and scalars of every record '''
+        with dmap_file_reader(self.filename) as reader:
+            records = np.zeros(len(reader), dtype = INDEX_DTYPE)
+            records['offset'] = reader.offsets
+            records['sze'] = reader.sizes
+
+            for recnum in range(len(reader)):
+                scalars, vectors = reader.readRecord(recnum, skip_vectors = True)
+                records['time'][recnum] = record_time(scalars)
+                for s in INDEX_SCALARS:
+                    records[s][recnum] = scalars.get(s, -1)
+
+        return records
+
+    def __len__(self):
+        return len(self.records)
+
+    def query(self, stime = None, etime = None, bmnum = None, channel = None, cp = None, scan = None):
+        ''' returns the record numbers with stime <= time < etime (datetimes) matching the given beam, channel, cp and scan '''
+        mask = np.ones(len(self.records), dtype = bool)
+
+        if stime is not None:
+            mask &= self.records['time'] >= datetime_to_epoch(stime)
+        if etime is not None:
+            mask &= self.records['time'] < datetime_to_epoch(etime)
+
+        for field, value in zip(INDEX_SCALARS, [bmnum, channel, cp, scan]):
+            if value is not None:
+                mask &= self.records[field] == value
+
+        return np.nonzero(mask)[0]
+
+    def open(self):
+        ''' returns a dmap_file_reader for the file that reuses this index instead of rescanning it '''
+        return dmap_file_reader(self.filename, offsets = self.records['offset'], sizes = self.records['sze'])
+
+    def readRecords(self, **kwargs):
+        ''' yields scalars, vectors for each record matching query(**kwargs), vectors are copies that outlive the reader '''
+        with self.open() as reader:
+            for recnum in self.query(**kwargs):
+                scalars, vectors = reader.readRecord(recnum)
+                # copy vectors out of the memory map before it is closed
+                for v in vectors:
+                    vectors[v] = np.array(vectors[v])
+                yield scalars, vectors
+
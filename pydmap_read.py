@@ -4,135 +4,474 @@
 
 import numpy as np
 import pdb
+import os
+import mmap
 import socket 
+import struct
+import select
+import errno
+import sys
 import time
 import json
+import base64
 import datetime
 import time
-
-DATACODE = 33
-DATACHAR = 1
-DATASHORT = 2
-DATAINT = 3
-DATAFLOAT = 4
-DATADOUBLE = 8
-DATASTRING = 9
-DATALONG = 10
-DATAUCHAR = 16
-DATAUSHORT = 17
-DATAUINT = 18
-DATAULONG = 19
-DATAMAP = 255
-NULL = chr(0)
-
-DTYPE_CODES = { \
-    DATACHAR:np.uint8,\
-    DATASHORT:np.int16,\
-    DATAINT:np.int32,\
-    DATAFLOAT:np.float32,\
-    DATASTRING:str}
+from multiprocessing.pool import ThreadPool
+from pydmap_codec import *
+from dmap_compress import block_reader, file_codec
 
 TIMEOUT = datetime.timedelta(seconds = 30)
 RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300 # reconnect backoff doubles from RESTART_DELAY up to this
+RECV_BUFSIZE = 1 << 20 # initial receive buffer size, grows to fit larger records
+RECV_CHUNK = 1 << 16 # minimum free space to offer each recv_into call
+LOOKUP_THREADS = 4 # background host name lookups of a dmap_feed_mux
+LOOKUP_POLL = .1 # seconds between checks on pending lookups
 
-def recv_dtype(sock, dtype, nitems = 1):
-    if dtype == str:
-        return recv_str(sock)
-    
-    dstr = ''
-    while len(dstr) < dtype().nbytes * nitems:
-        dstr += sock.recv(1)
-
-    data = np.fromstring(dstr, dtype=dtype, count=nitems)
-    if nitems == 1:
-        return data[0]
-    return data
-
-def recv_str(sock):
-    dstr = ''
-    c = sock.recv(1)
-
-    while c != NULL:
-        dstr += c
-        c = sock.recv(1)
-    return dstr
-
-def readPacket(sock):
-    timeout = False
-    scalars = {}
-    vectors = {}
-
-    # read in header
-    datacode = recv_dtype(sock, np.int32)
-
-    # this isn't very robust.. try to find header.. or something that looks like header
-    starttime = datetime.datetime.now()
+class dmap_stream(object):
+    ''' buffered reader for dmap records arriving over a socket
+        bytes are pulled in large chunks with recv_into, records are cut out using the sze header field '''
+    def __init__(self, sock, bufsize = RECV_BUFSIZE):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte not yet consumed
+        self.end = 0 # end of valid data in buf
+        self.skipped = 0 # bytes thrown away resynchronizing
 
-    while datacode != 65537:
-        print 'looking for header..'
-        datacode = recv_dtype(sock, np.int32)
-
-        if (starttime - datetime.datetime.now()) > TIMEOUT:
-            timeout = True
-            break
-    
-    if not timeout:
-        sze = recv_dtype(sock, np.int32)
-        snum = recv_dtype(sock, np.int32)
-        anum = recv_dtype(sock, np.int32)
-
-        # read in scalars
-        for s in range(snum):
-            name = recv_str(sock)
-            dtype = DTYPE_CODES[recv_dtype(sock, np.uint8)]
-            payload = recv_dtype(sock, dtype)
-            scalars[name] = payload
-
-        # read in vectors
-        for a in range(anum):
-            name = recv_str(sock)
-            dtype = DTYPE_CODES[recv_dtype(sock, np.uint8)]
-            ndims = recv_dtype(sock, np.int32)
-            dims = recv_dtype(sock, np.int32, ndims)
-            payload = recv_dtype(sock, dtype, np.prod(dims))
-            if ndims > 1:
-                payload = np.reshape(payload, tuple(dims[::-1]))
-            vectors[name] = payload
-    
-    return scalars, vectors, timeout
+    def fill(self):
+        ''' receives whatever is available from the socket, returns the number of bytes read (0 on close) '''
+        if len(self.buf) - self.end < RECV_CHUNK:
+            self._compact(RECV_CHUNK)
+        nbytes = self.sock.recv_into(self.view[self.end:])
+        self.end += nbytes
+        return nbytes
 
-def createjson(scalars, vectors):
-    json_payload = {}
+    def _compact(self, need):
+        ''' moves unconsumed data to the front of the buffer, grows the buffer until need more bytes fit '''
+        nvalid = self.end - self.start
+        size = len(self.buf)
+        while size - nvalid < need:
+            size *= 2
+
+        if size != len(self.buf):
+            buf = bytearray(size)
+            buf[:nvalid] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        elif self.start:
+            # source and destination may overlap, so go through a temporary copy
+            self.buf[:nvalid] = self.view[self.start:self.end].tobytes()
+
+        self.start = 0
+        self.end = nvalid
+
+    def _skip(self, offset):
+        ''' throws away bytes up to offset while resynchronizing '''
+        if offset > self.start:
+            print >> sys.stderr, 'skipped {} bytes looking for a header'.format(offset - self.start)
+            self.skipped += offset - self.start
+            self.start = offset
+
+    def popRecord(self):
+        ''' decodes the next complete record in the buffer, resynchronizing past anything that isn't a record
+            returns scalars, vectors or None if a full record has not arrived yet '''
+        while True:
+            offset, complete = find_record(self.buf, self.start, self.end)
+            self._skip(offset)
+
+            if not complete:
+                if self.end - self.start >= HEADER_STRUCT.size:
+                    sze = HEADER_STRUCT.unpack_from(self.buf, self.start)[1]
+                    if sze > len(self.buf) - self.start:
+                        self._compact(sze - (self.end - self.start))
+                return None
+
+            # one copy out of the receive buffer, the decoded vectors are views into it
+            sze = HEADER_STRUCT.unpack_from(self.buf, self.start)[1]
+            record = self.view[self.start:self.start + sze].tobytes()
+
+            try:
+                scalars, vectors, end = parse_record(record)
+            except (ValueError, struct.error):
+                # checked out but doesn't decode, look for the next header
+                self._skip(self.start + 1)
+                continue
+
+            self.start += sze
+            if self.start == self.end:
+                self.start = self.end = 0
+            return scalars, vectors
+
+class dmap_file_reader(object):
+    ''' random access reader for dmap files on disk
+        the file is memory mapped and only the record headers are scanned on open,
+        records are decoded on demand and their vectors are views into the mapping, close only drops the reader's
+        reference to it so views keep the mapping alive until they are garbage collected
+        gzip, bz2 and zstd files are decompressed into memory, unless offsets are given and the file
+        has a block index, then only the blocks holding a record are decompressed when it is read '''
+    def __init__(self, filename, offsets = None, sizes = None):
+        ''' offsets and sizes of the records may be passed in (from a dmap_index) to skip the header scan '''
+        self.filename = filename
+        self.fp = open(filename, 'rb')
+        self.codec = file_codec(self.fp)
+        self.blocks = None
+        self.skipped = 0 # corrupt bytes passed over by the header scan
+
+        if self.codec is not None:
+            self.blocks = block_reader(filename)
+            if offsets is None or self.blocks.blocks is None:
+                self.mmap = self.blocks.readAll()
+            else:
+                self.mmap = None
+            self.size = self.blocks.size if self.mmap is None else len(self.mmap)
+        else:
+            self.size = os.fstat(self.fp.fileno()).st_size
+            # mmap refuses empty files
+            if self.size:
+                self.mmap = mmap.mmap(self.fp.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                self.mmap = b''
+
+        if offsets is None:
+            self.offsets, self.sizes = self._scanHeaders()
+        else:
+            self.offsets, self.sizes = offsets, sizes
 
-    for scalar in scalars.keys():
-        payload = scalars[scalar]
-        if isinstance(payload, str):
-            json_payload[scalar] = payload
+    def _plausibleHeader(self, offset):
+        ''' quick check of the header at offset, only the datacode and size are looked at '''
+        if offset == self.size:
+            return True
+        if offset + HEADER_STRUCT.size > self.size:
+            return False
+        datacode, sze, snum, anum = HEADER_STRUCT.unpack_from(self.mmap, offset)
+        return datacode in DATACODES and HEADER_STRUCT.size <= sze <= self.size - offset
+
+    def _scanHeaders(self):
+        ''' walks the record headers, returns arrays of record offsets and sizes
+            records are only fully checked when their header or the one after them looks wrong,
+            anything that fails the check is skipped by resynchronizing on the next good record '''
+        offsets = []
+        sizes = []
+        offset = 0
+
+        while offset + HEADER_STRUCT.size <= self.size:
+            sze = HEADER_STRUCT.unpack_from(self.mmap, offset)[1]
+            if not self._plausibleHeader(offset) or not self._plausibleHeader(offset + sze):
+                if not check_record(self.mmap, offset, self.size):
+                    resync, complete = find_record(self.mmap, offset + 1, self.size)
+                    if not complete:
+                        print >> sys.stderr, 'truncated or corrupt record at byte {} of {}'.format(offset, self.filename)
+                        break
+                    print >> sys.stderr, 'skipped {} corrupt bytes at byte {} of {}'.format(resync - offset, offset, self.filename)
+                    self.skipped += resync - offset
+                    offset = resync
+                    sze = HEADER_STRUCT.unpack_from(self.mmap, offset)[1]
+
+            offsets.append(offset)
+            sizes.append(sze)
+            offset += sze
+
+        return np.array(offsets, dtype = np.int64), np.array(sizes, dtype = np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for recnum in range(len(self)):
+            yield self.readRecord(recnum)
+
+    def readBytes(self, offset, size):
+        ''' returns size bytes of the (decompressed) file at offset '''
+        if self.mmap is None:
+            return self.blocks.read(offset, size)
+        return self.mmap[offset:offset + size]
+
+    def getRecordBytes(self, recnum):
+        ''' returns the raw bytes of record recnum as a uint8 array viewing the mapping '''
+        if self.mmap is None:
+            return np.frombuffer(self.readBytes(int(self.offsets[recnum]), int(self.sizes[recnum])), dtype = np.uint8)
+        return np.frombuffer(self.mmap, dtype = np.uint8, count = self.sizes[recnum], offset = self.offsets[recnum])
+
+    def readRecord(self, recnum, skip_vectors = False):
+        ''' decodes record recnum, returns scalars, vectors '''
+        if self.mmap is None:
+            buf = self.readBytes(int(self.offsets[recnum]), int(self.sizes[recnum]))
+            scalars, vectors, end = parse_record(buf, 0, skip_vectors)
         else:
-            json_payload[scalar] = np.asscalar(payload)
+            scalars, vectors, end = parse_record(self.mmap, int(self.offsets[recnum]), skip_vectors)
+        return scalars, vectors
+
+    def close(self):
+        # the mapping isn't closed, that would leave decoded vectors pointing at unmapped memory
+        if self.blocks is not None:
+            self.blocks.close()
+        self.mmap = b''
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def readPacket(stream):
+    starttime = datetime.datetime.now()
+    record = stream.popRecord()
+
+    while record is None:
+        if (datetime.datetime.now() - starttime) > TIMEOUT:
+            return {}, {}, True
+        try:
+            if not stream.fill():
+                return {}, {}, True
+        except socket.timeout:
+            return {}, {}, True
+        record = stream.popRecord()
+
+    scalars, vectors = record
+    return scalars, vectors, False
 
-    for vector in vectors.keys():
-        payload = vectors[vector]
-        # convert numpy array to list, recursively traverse and convert to jsonable data type..
-        payload = payload.tolist()
-        json_payload[vector] = payload
-    return json.dumps(json_payload)
+class dmap_feed(object):
+    ''' one realtime server connection of a dmap_feed_mux, with its own stream buffer and reconnect backoff '''
+    def __init__(self, site, host, port):
+        self.site = site
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.stream = None
+        self.connecting = False
+        self.delay = RESTART_DELAY
+        self.retry_time = 0
+        self.last_data = 0
+        self.address = None # resolved (ip, port), looked up in the background by the mux
+        self.lookup = None # pending lookup
+
+    def resolve(self, now, resolver):
+        ''' starts looking up the host in a resolver thread pool, or takes the address once the lookup is done
+            returns True when the feed has an address to connect to '''
+        if self.address is not None:
+            return True
+        if self.lookup is None:
+            self.lookup = resolver.apply_async(socket.getaddrinfo, (self.host, self.port, socket.AF_INET, socket.SOCK_STREAM))
+            return False
+        if not self.lookup.ready():
+            return False
+
+        lookup, self.lookup = self.lookup, None
+        try:
+            self.address = lookup.get()[0][4]
+        except (socket.error, IndexError):
+            self.disconnect(now)
+            return False
+        return True
+
+    def connect(self, now):
+        self.stream = None
+        self.connecting = True
+        self.last_data = now
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            self.stream = dmap_stream(self.sock)
+            err = self.sock.connect_ex(self.address)
+        except socket.error:
+            err = None
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.disconnect(now)
+
+    def checkConnected(self, now):
+        ''' called once a connecting socket is writable, finishes or fails the connection '''
+        self.connecting = False
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.disconnect(now)
+
+    def disconnect(self, now):
+        ''' drops the connection and schedules the next attempt, backing off while the server stays down '''
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.stream = None
+        self.connecting = False
+        self.address = None # looked up again before reconnecting, in case the server moved
+        self.retry_time = now + self.delay
+        self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class dmap_feed_mux(object):
+    ''' fans in records from many realtime servers in a single process
+        every connection is non-blocking, parsed incrementally and reconnected independently '''
+    def __init__(self, servers):
+        ''' servers maps a site name to a (host, port) tuple
+            host names are looked up in a thread pool, so a slow or failing lookup only holds up its own feed '''
+        self.feeds = [dmap_feed(site, host, port) for site, (host, port) in sorted(servers.items())]
+        self.resolver = ThreadPool(LOOKUP_THREADS)
+
+    def records(self):
+        ''' yields (site, scalars, vectors) for records from every server as they arrive, forever '''
+        while True:
+            now = time.time()
+            for feed in self.feeds:
+                if feed.sock is None and feed.retry_time <= now:
+                    if feed.resolve(now, self.resolver):
+                        feed.connect(now)
+                elif feed.sock is not None and now - feed.last_data > TIMEOUT.total_seconds():
+                    feed.disconnect(now)
+
+            readers = [f for f in self.feeds if f.sock is not None and not f.connecting]
+            writers = [f for f in self.feeds if f.sock is not None and f.connecting]
+            retries = [f.retry_time - now for f in self.feeds if f.sock is None and f.lookup is None]
+            if any(f.lookup is not None for f in self.feeds):
+                retries.append(LOOKUP_POLL)
+            wait = min([RESTART_DELAY] + retries)
+
+            readable, writable, errored = select.select(readers, writers, [], max(wait, 0))
+            now = time.time()
+
+            for feed in writable:
+                feed.checkConnected(now)
+
+            for feed in readable:
+                try:
+                    nbytes = feed.stream.fill()
+                except socket.error:
+                    nbytes = 0
+                if not nbytes:
+                    feed.disconnect(now)
+                    continue
+
+                feed.last_data = now
+                record = feed.stream.popRecord()
+                while record is not None:
+                    feed.delay = RESTART_DELAY
+                    yield (feed.site, record[0], record[1])
+                    record = feed.stream.popRecord()
+
+# printf style formats for json numbers, float32 needs 9 significant digits to round trip and float64 17
+JSON_FORMATS = { \
+    'i':'%d',\
+    'u':'%d',\
+    'b':'%d',\
+    'f4':'%.9g',\
+    'f8':'%.17g'}
+
+def _json_format(dtype):
+    ''' returns the printf format for numbers of dtype, or None if they can't be formatted that way '''
+    if dtype.kind == 'f':
+        return JSON_FORMATS.get('f{}'.format(dtype.itemsize))
+    return JSON_FORMATS.get(dtype.kind)
+
+def _json_template(fmt, shape):
+    ''' builds a template for a nested json list of the given shape, filled in with a tuple of the flattened values '''
+    if not shape:
+        return fmt
+    inner = _json_template(fmt, shape[1:])
+    return '[' + ','.join([inner] * shape[0]) + ']'
+
+class json_encoder(object):
+    ''' encodes decoded records as single line json objects
+        vectors are written with templates compiled once per dtype and shape instead of going through tolist and json.dumps,
+        or with b64 as {"dtype", "shape", "data"} objects holding the base64 encoded array buffer
+        fields limits the output to the named scalars and vectors '''
+    def __init__(self, fields = None, b64 = False):
+        self.fields = None if fields is None else set(fields)
+        self.b64 = b64
+        self.keys = {} # field name -> encoded json key
+        self.templates = {} # (dtype, shape) -> vector template
+
+    def _key(self, name):
+        key = self.keys.get(name)
+        if key is None:
+            key = self.keys[name] = json.dumps(name) + ':'
+        return key
+
+    def encodeMap(self, value):
+        ''' nested maps are decoded as (scalars, vectors) and written as json objects of all their fields '''
+        scalars, vectors = value
+        return self._encodeFields(scalars, vectors, None)
+
+    def encodeScalar(self, value):
+        if isinstance(value, str):
+            return json.dumps(value)
+        if isinstance(value, tuple):
+            return self.encodeMap(value)
+        fmt = _json_format(np.asarray(value).dtype)
+        if fmt is None or (fmt[-1] == 'g' and not np.isfinite(value)):
+            return json.dumps(np.asarray(value).item())
+        return fmt % value
+
+    def encodeVector(self, value):
+        if self.b64 and value.dtype.kind in 'iubf':
+            data = base64.b64encode(np.ascontiguousarray(value).tobytes())
+            return '{{"dtype":"{}","shape":{},"data":"{}"}}'.format(value.dtype.str, json.dumps(value.shape), data)
+
+        if value.dtype == object and value.size and isinstance(value.flat[0], tuple):
+            return _json_template('%s', value.shape) % tuple(self.encodeMap(m) for m in value.flat)
+
+        fmt = _json_format(value.dtype)
+        if fmt is None or not value.size or (fmt[-1] == 'g' and not np.isfinite(value).all()):
+            # strings and non finite floats take the slow path
+            return json.dumps(value.tolist(), default = lambda obj: obj.tolist())
+
+        key = (value.dtype.str, value.shape)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = _json_template(fmt, value.shape)
+        return template % tuple(value.ravel().tolist())
+
+    def _encodeFields(self, scalars, vectors, fields):
+        items = []
+        for name, value in scalars.items():
+            if fields is None or name in fields:
+                items.append(self._key(name) + self.encodeScalar(value))
+        for name, value in vectors.items():
+            if fields is None or name in fields:
+                items.append(self._key(name) + self.encodeVector(value))
+        return '{' + ','.join(items) + '}'
+
+    def encode(self, scalars, vectors):
+        ''' returns a record as a json object on one line '''
+        return self._encodeFields(scalars, vectors, self.fields)
+
+def write_ndjson(records, f, fields = None, b64 = False):
+    ''' writes (scalars, vectors) records to file object f as newline delimited json, returns the number of records written '''
+    encoder = json_encoder(fields = fields, b64 = b64)
+    nrecords = 0
+    for scalars, vectors in records:
+        f.write(encoder.encode(scalars, vectors))
+        f.write('\n')
+        nrecords += 1
+    return nrecords
+
+_default_encoder = json_encoder()
+
+def createjson(scalars, vectors):
+    return _default_encoder.encode(scalars, vectors)
 
 
 def main():
-    HOST = 'superdarn.gi.alaska.edu'
-    PORT = 6024
-    timeout = False
-
-    while True:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((HOST, PORT)) 
-        while not timeout:
-            scalars, vectors, timeout = readPacket(s)
-            json_str = createjson(scalars, vectors)
-            print json_str
-        s.close() 
-        time.sleep(RESTART_DELAY)
+    # servers are given as site=host:port arguments, --b64 and --fields=name,name.. control the json output
+    servers = {}
+    fields = None
+    b64 = False
+    for arg in sys.argv[1:]:
+        if arg == '--b64':
+            b64 = True
+        elif arg.startswith('--fields='):
+            fields = arg.split('=', 1)[1].split(',')
+        else:
+            site, server = arg.split('=')
+            host, port = server.split(':')
+            servers[site] = (host, int(port))
+    if not servers:
+        servers = {'superdarn.gi.alaska.edu:6024' : ('superdarn.gi.alaska.edu', 6024)}
+
+    encoder = json_encoder(fields = fields, b64 = b64)
+    for site, scalars, vectors in dmap_feed_mux(servers).records():
+        sys.stdout.write(encoder.encode(scalars, vectors) + '\n')
+        sys.stdout.flush()
 
 
 
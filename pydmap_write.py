@@ -5,115 +5,371 @@ import numpy as np
 import collections
 import struct
 import pdb
+from pydmap_codec import *
+from dmap_compress import open_output
 
-DATACODE = 33
-DATACHAR = 1
-DATASHORT = 2
-DATAINT = 3
-DATAFLOAT = 4
-DATADOUBLE = 8
-DATASTRING = 9
-DATALONG = 10
-DATAUCHAR = 16
-DATAUSHORT = 17
-DATAUINT = 18
-DATAULONG = 19
-DATAMAP = 255
-NULL = chr(0)
-
-DTYPE_CODES = { \
-    np.uint8:DATACHAR,\
-    np.int16:DATASHORT,\
-    np.int32:DATAINT,\
-    np.float32:DATAFLOAT,\
-    str:DATASTRING}
-
-class dmap_var:
+VECTOR_DIM_BYTES = INT_STRUCT.size
+
+# scalars common to every record, name, default value and type
+RECORD_SCALARS = [ \
+    ('radar.revision.major', 0, np.uint8),\
+    ('radar.revision.minor', 0, np.uint8),\
+    ('origin.code', 0, np.uint8),\
+    ('origin.time', 'test time string', str),\
+    ('origin.command', 'pydmap_write.py', str),\
+    ('cp', 0, np.int16),\
+    ('stid', 0, np.int16),\
+    ('time.yr', 0, np.int16),\
+    ('time.mo', 0, np.int16),\
+    ('time.dy', 0, np.int16),\
+    ('time.hr', 0, np.int16),\
+    ('time.mt', 0, np.int16),\
+    ('time.sc', 0, np.int16),\
+    ('time.us', 0, np.int32),\
+    ('txpow', 0, np.int16),\
+    ('nave', 0, np.int16),\
+    ('atten', 0, np.int16),\
+    ('lagfr', 0, np.int16),\
+    ('smsep', 0, np.int16),\
+    ('ercod', 0, np.int16),\
+    ('stat.agc', 0, np.int16),\
+    ('noise.search', 0, np.float32),\
+    ('noise.mean', 0, np.float32),\
+    ('channel', 0, np.int16),\
+    ('bmnum', 0, np.int16),\
+    ('bmazm', 0, np.float32),\
+    ('scan', 0, np.int16),\
+    ('offset', 0, np.int16),\
+    ('rxrise', 0, np.int16),\
+    ('intt.sc', 0, np.int16),\
+    ('intt.us', 0, np.int32),\
+    ('txpl', 0, np.int16),\
+    ('mpinc', 0, np.int16),\
+    ('mppul', 8, np.int16),\
+    ('mplgs', 3, np.int16),\
+    ('nrang', 4, np.int16),\
+    ('frang', 0, np.int16),\
+    ('rsep', 0, np.int16),\
+    ('xcf', 0, np.int16),\
+    ('tfreq', 0, np.int16),\
+    ('mxpwr', 0, np.int32),\
+    ('lvmax', 0, np.int32),\
+    ('combf', 0, str)]
+
+# time scalars and the datetime attributes they come from
+TIME_ATTRS = [ \
+    ('time.yr', 'year'),\
+    ('time.mo', 'month'),\
+    ('time.dy', 'day'),\
+    ('time.hr', 'hour'),\
+    ('time.mt', 'minute'),\
+    ('time.sc', 'second'),\
+    ('time.us', 'microsecond')]
+
+FITACF_SCALARS = RECORD_SCALARS + [ \
+    ('fitacf.revision.major', 0, np.int32),\
+    ('fitacf.revision.minor', 0, np.int32),\
+    ('noise.sky', 0, np.float32),\
+    ('noise.lag0', 0, np.float32),\
+    ('noise.vel', 0, np.float32)]
+
+# vectors, name, default value, dims (numbers or names of the scalars holding them) and type
+FITACF_VECTORS = [ \
+    ('ptab', 0, ('mppul',), np.int16),\
+    ('ltab', 0, (2, 'mplgs'), np.int16),\
+    ('pwr0', 0, ('nrang',), np.float32),\
+    ('slist', 0, ('nrang',), np.int16),\
+    ('nlag', 0, ('nrang',), np.int16),\
+    ('qflg', 0, ('nrang',), np.uint8),\
+    ('gflg', 0, ('nrang',), np.uint8),\
+    ('p_l', 0, ('nrang',), np.float32),\
+    ('p_l_e', 0, ('nrang',), np.float32),\
+    ('p_s', 0, ('nrang',), np.float32),\
+    ('p_s_e', 0, ('nrang',), np.float32),\
+    ('v', 0, ('nrang',), np.float32),\
+    ('v_e', 0, ('nrang',), np.float32),\
+    ('w_l', 0, ('nrang',), np.float32),\
+    ('w_l_e', 0, ('nrang',), np.float32),\
+    ('w_s', 0, ('nrang',), np.float32),\
+    ('w_s_e', 0, ('nrang',), np.float32),\
+    ('sd_l', 0, ('nrang',), np.float32),\
+    ('sd_s', 0, ('nrang',), np.float32),\
+    ('sd_phi', 0, ('nrang',), np.float32)]
+
+class dmap_var(object):
     def __init__(self, data, dtype):
+        self.layout = None
         self.setType(dtype)
         self.setData(data)
 
+    def bind(self, layout, offset):
+        ''' moves the variable onto its already encoded payload at offset in the buffer of layout
+            vectors keep their array, which callers may hold from getData, and are copied into the buffer by getBuffer
+            returns False if the variable can't be updated in place '''
+        self.layout = None
+        if type(self.data) == np.ndarray:
+            if self.code not in CODE_STRUCTS:
+                return False
+            view = np.frombuffer(layout.buf, dtype = DTYPE_NPDTYPES[self.dtype], count = self.data.size, offset = offset)
+            layout.copies.append((view.reshape(self.data.shape), self))
+        elif self.code == DATAMAP:
+            return False
+
+        self.layout = layout
+        self.offset = offset
+        return True
+
+    def _setInPlace(self, data):
+        ''' writes data through to the layout buffer, returns False if it doesn't fit the current layout '''
+        if type(self.data) == np.ndarray:
+            if np.shape(data) != self.data.shape:
+                return False
+            self.data[...] = data
+        elif type(data) == np.ndarray:
+            return False
+        elif self.dtype == str:
+            data = str(data)
+            if len(data) != len(self.data):
+                return False
+            struct.pack_into('%ds' % len(data), self.layout.buf, self.offset, data)
+            self.data = data
+        else:
+            self.data = self.dtype(data)
+            DTYPE_STRUCTS[self.dtype].pack_into(self.layout.buf, self.offset, self.data)
+        return True
+
     def setData(self, data):
-        if type(data) == np.ndarray:
+        if self.layout is not None:
+            if self._setInPlace(data):
+                return
+            # the new value changes the size of the record, it is laid out again on the next write
+            self.layout.valid = False
+            self.layout = None
+
+        if self.dtype == dmap_record:
+            # nested maps, a record or an array of records
+            if isinstance(data, dmap_record):
+                self.data = data
+            else:
+                self.data = np.array(data, dtype = object)
+        elif type(data) == np.ndarray:
             self.data = np.array(data, dtype = self.dtype)
         else:
             self.data = self.dtype(data)
 
     def setType(self, dtype):
         self.dtype = dtype
+        if dtype == dmap_record:
+            self.code = DATAMAP
+        else:
+            self.code = DTYPE_CODES[dtype]
 
     def getData(self):
         return self.data
 
-    def getDmapPack(self, name):
-        datastr = name + NULL + chr(DTYPE_CODES[self.dtype])
+    def _elementSize(self, element):
+        ''' returns the encoded size of one string or map element '''
+        if self.code == DATAMAP:
+            return element.getPackSize()
+        return len(element) + 1
+
+    def _packElement(self, buf, offset, element):
+        ''' packs one string or map element at offset, returns the offset after it '''
+        if self.code == DATAMAP:
+            return element.packInto(buf, offset)
+        struct.pack_into('%dsx' % len(element), buf, offset, element)
+        return offset + len(element) + 1
+
+    def getHeaderSize(self, name):
+        ''' returns the number of bytes in front of the payload, for the name, type code and dims '''
+        size = len(name) + 2
+        if type(self.data) == np.ndarray:
+            size += VECTOR_DIM_BYTES * (self.data.ndim + 1)
+        return size
+
+    def getPackSize(self, name):
+        ''' returns the number of bytes getDmapPack/packInto will produce for this variable '''
+        size = self.getHeaderSize(name)
+
+        if type(self.data) == np.ndarray:
+            if self.code in CODE_STRUCTS:
+                size += self.data.nbytes
+            else:
+                size += sum(self._elementSize(e) for e in self.data.flat)
+        elif self.code in CODE_STRUCTS:
+            size += DTYPE_STRUCTS[self.dtype].size
+        else:
+            size += self._elementSize(self.data)
+
+        return size
+
+    def packInto(self, buf, offset, name):
+        ''' packs the variable into writable buffer buf at offset, returns the offset after the variable '''
+        struct.pack_into('%dsxB' % len(name), buf, offset, name, self.code)
+        offset += len(name) + 2
+
         if type(self.data) == np.ndarray:
             dims = self.data.shape[::-1]
+            struct.pack_into('<%di' % (len(dims) + 1), buf, offset, len(dims), *dims)
+            offset += VECTOR_DIM_BYTES * (len(dims) + 1)
 
-            datastr += np.int32(len(dims)).tobytes()
-            for d in dims:
-                datastr += np.int32(d).tobytes()
+            if self.code in CODE_STRUCTS:
+                # copy straight from the numpy buffer into the record buffer
+                dest = np.frombuffer(buf, dtype = DTYPE_NPDTYPES[self.dtype], count = self.data.size, offset = offset)
+                dest[:] = np.ravel(self.data)
+                offset += self.data.nbytes
+            else:
+                for element in self.data.flat:
+                    offset = self._packElement(buf, offset, element)
 
-        if self.dtype != str:
-            datastr += self.data.tobytes()
+        elif self.code in CODE_STRUCTS:
+            DTYPE_STRUCTS[self.dtype].pack_into(buf, offset, self.data)
+            offset += DTYPE_STRUCTS[self.dtype].size
         else:
-            datastr += (self.data + NULL)
+            offset = self._packElement(buf, offset, self.data)
+
+        return offset
+
+    def getDmapPack(self, name):
+        buf = bytearray(self.getPackSize(name))
+        self.packInto(buf, 0, name)
+        return bytes(buf)
+
+def pack_fields(buf, offset, scalars, vectors, payloads = None):
+    ''' encodes a header and ordered dicts of scalar and vector dmap_vars as a record into buf at offset
+        appends the payload offset of every field to payloads if given, returns the offset after the record '''
+    start = offset
+
+    offset += HEADER_STRUCT.size
+    for fields in (scalars, vectors):
+        for name in fields:
+            if payloads is not None:
+                payloads.append(offset + fields[name].getHeaderSize(name))
+            offset = fields[name].packInto(buf, offset, name)
+
+    HEADER_STRUCT.pack_into(buf, start, DATACODE, offset - start, len(scalars), len(vectors))
+    return offset
+
+def time_columns(times):
+    ''' returns time.yr .. time.us columns for packColumns from a sequence of datetimes '''
+    columns = {}
+    for field, attr in TIME_ATTRS:
+        columns[field] = np.array([getattr(t, attr) for t in times])
+    return columns
+
+class dmap_layout(object):
+    ''' an encoded record buffer, variables bound to a layout write their payload straight into it
+        the layout is invalidated when a variable no longer fits, the record is then encoded again '''
+    def __init__(self, buf):
+        self.buf = buf
+        self.valid = True
+        self.copies = [] # (payload view, variable) of vectors that aren't views into buf
+
+class dmap_schema(object):
+    ''' compiled layout of a record type for one set of vector shapes and string lengths
+        names, type codes and dims of every field are encoded once into a template along with their payload offsets,
+        new records copy the template and bind their variables to it '''
+    def __init__(self, scalars, vectors):
+        ''' scalars and vectors are lists of name, value and type, vector values already have their final shape '''
+        protos = collections.OrderedDict(), collections.OrderedDict()
+        size = HEADER_STRUCT.size
+        for fields, proto in zip((scalars, vectors), protos):
+            for name, value, dtype in fields:
+                proto[name] = dmap_var(value, dtype)
+                size += proto[name].getPackSize(name)
+
+        payloads = []
+        self.template = bytearray(size)
+        pack_fields(self.template, 0, protos[0], protos[1], payloads)
+
+        # name, type, code, payload offset and value of each scalar
+        self.scalars = []
+        for (name, value, dtype), offset in zip(scalars, payloads):
+            self.scalars.append((name, dtype, DTYPE_CODES[dtype], offset, protos[0][name].data))
+
+        # name, type, code, payload offset, numpy dtype, element count and shape of each vector
+        self.vectors = []
+        for (name, value, dtype), offset in zip(vectors, payloads[len(scalars):]):
+            shape = protos[1][name].data.shape
+            self.vectors.append((name, dtype, DTYPE_CODES[dtype], offset, DTYPE_NPDTYPES[dtype], int(np.prod(shape)), shape))
+
+    def instantiate(self):
+        ''' returns a layout holding a copy of the template and ordered dicts of scalars and vectors bound to it '''
+        layout = dmap_layout(bytearray(self.template))
+        buf = layout.buf
+        new_var = dmap_var.__new__
+        scalars = collections.OrderedDict()
+        vectors = collections.OrderedDict()
+
+        for name, dtype, code, offset, value in self.scalars:
+            var = new_var(dmap_var)
+            var.dtype, var.code, var.layout, var.offset, var.data = dtype, code, layout, offset, value
+            scalars[name] = var
 
-        return datastr
+        for name, dtype, code, offset, npdtype, count, shape in self.vectors:
+            var = new_var(dmap_var)
+            var.dtype, var.code, var.layout, var.offset = dtype, code, layout, offset
+            var.data = np.frombuffer(buf, dtype = npdtype, count = count, offset = offset).reshape(shape)
+            vectors[name] = var
+
+        return layout, scalars, vectors
+
+# compiled schemas keyed by record type, string lengths and vector shapes, and defaults keyed by record type
+_schema_cache = {}
 
 class dmap_record(object):
-    def __init__(self, filename = ''):
-        self.scalars = collections.OrderedDict()
-        self.vectors = collections.OrderedDict()
+    SCALARS = RECORD_SCALARS
+    VECTORS = []
+
+    def __init__(self, filename = '', scalars = {}, vectors = {}):
         self.filename = filename
 
-        self.addScalar('radar.revision.major', 0, np.uint8)
-        self.addScalar('radar.revision.minor', 0, np.uint8)
-        self.addScalar('origin.code', 0, np.uint8)
-        self.addScalar('origin.time', 'test time string', str)
-        self.addScalar('origin.command', 'pydmap_write.py', str)
-
-        self.addScalar('cp', 0, np.int16)
-        self.addScalar('stid', 0, np.int16)
-        self.addScalar('time.yr', 0, np.int16)
-        self.addScalar('time.mo', 0, np.int16)
-        self.addScalar('time.dy', 0, np.int16)
-        self.addScalar('time.hr', 0, np.int16)
-        self.addScalar('time.mt', 0, np.int16)
-        self.addScalar('time.sc', 0, np.int16)
-        self.addScalar('time.us', 0, np.int32)
-        self.addScalar('txpow', 0, np.int16)
-        self.addScalar('nave', 0, np.int16)
-        self.addScalar('atten', 0, np.int16)
-        self.addScalar('lagfr', 0, np.int16)
-        self.addScalar('smsep', 0, np.int16)
-        self.addScalar('ercod', 0, np.int16)
-        self.addScalar('stat.agc', 0, np.int16)
-        self.addScalar('noise.search', 0, np.float32)
-        self.addScalar('noise.mean', 0, np.float32)
-        self.addScalar('channel', 0, np.int16)
-        self.addScalar('bmnum', 0, np.int16)
-        self.addScalar('bmazm', 0, np.float32)
-        self.addScalar('scan', 0, np.int16)
-        self.addScalar('offset', 0, np.int16)
-        self.addScalar('rxrise', 0, np.int16)
-        self.addScalar('intt.sc', 0, np.int16)
-        self.addScalar('intt.us', 0, np.int32)
-        self.addScalar('txpl', 0, np.int16)
-        self.addScalar('mpinc', 0, np.int16)
-        self.addScalar('mppul', 8, np.int16)
-        self.addScalar('mplgs', 3, np.int16)
-        self.addScalar('nrang', 4, np.int16)
-        self.addScalar('frang', 0, np.int16)
-        self.addScalar('rsep', 0, np.int16)
-        self.addScalar('xcf', 0, np.int16)
-        self.addScalar('tfreq', 0, np.int16)
-        self.addScalar('mxpwr', 0, np.int32)
-        self.addScalar('lvmax', 0, np.int32)
-        self.addScalar('combf', 0, str)
-        
+        schema = self.getSchema(scalars, vectors)
+        self.layout, self.scalars, self.vectors = schema.instantiate()
+
+        # the template holds the strings of whichever record compiled it, put back the defaults of unset ones
+        defaults, strings = _schema_cache[type(self)]
+        for s in strings:
+            if s not in scalars:
+                self.scalars[s].setData(defaults[s])
+
+        for s in scalars:
+            self.scalars[s].setData(scalars[s])
+        for v in vectors:
+            self.vectors[v].setData(vectors[v])
+
         if self.filename:
-            self.dmap_file = file(self.filename, 'w')
+            self.dmap_file = open_output(self.filename)
+
+    @classmethod
+    def getSchema(cls, scalars = {}, vectors = {}):
+        ''' returns the compiled schema of this record type for the given scalar and vector overrides '''
+        if cls not in _schema_cache:
+            # defaults and string fields of the record type, the only scalars that change the layout
+            defaults = dict((name, value) for name, value, dtype in cls.SCALARS)
+            strings = [name for name, value, dtype in cls.SCALARS if dtype == str]
+            _schema_cache[cls] = defaults, strings
+        defaults, strings = _schema_cache[cls]
+
+        key = [cls]
+        for name in strings:
+            key.append(len(str(scalars.get(name, defaults[name]))))
+        for name, value, dims, dtype in cls.VECTORS:
+            if name in vectors:
+                key.append(np.shape(vectors[name]))
+            else:
+                key.append(tuple(int(scalars.get(d, defaults[d])) if isinstance(d, str) else d for d in dims))
+        key = tuple(key)
+
+        if key not in _schema_cache:
+            # strings only need the right length in the template, the record sets them all after copying it
+            scalar_fields = [(name, scalars.get(name, value) if dtype == str else value, dtype) for name, value, dtype in cls.SCALARS]
+            vector_fields = []
+            for (name, value, dims, dtype), shape in zip(cls.VECTORS, key[1 + len(strings):]):
+                vector_fields.append((name, value * np.ones(shape, dtype = dtype), dtype))
+            _schema_cache[key] = dmap_schema(scalar_fields, vector_fields)
+
+        return _schema_cache[key]
 
     def setData(self, scalars, vectors):
         for s in scalars:
@@ -121,7 +377,7 @@ class dmap_record(object):
         for v in vectors:
             self.scalars[s].setData(scalars[s])
 
-    # sets time from input datetime dt 
+    # sets time from input datetime dt
     def setTime(self, dt):
         self.scalars['time.yr'].setData(dt.year)
         self.scalars['time.mo'].setData(dt.month)
@@ -132,32 +388,100 @@ class dmap_record(object):
         self.scalars['time.us'].setData(dt.microsecond)
 
 
-    def _makeHeader(self):
-        datacode = DATACODE
-        sze = len(self.vector_str) + len(self.scalar_str) + 4 * np.int32().nbytes
-        anum = len(self.vectors)
-        snum = len(self.scalars)
-
-        self.header = struct.pack('iiii', datacode, sze, snum, anum)
-    
-    def _makeScalarStr(self):
-        self.scalar_str = ''
+    def getPackSize(self):
+        ''' returns the encoded size of the record in bytes, including the header '''
+        sze = HEADER_STRUCT.size
         for s in self.scalars:
-            self.scalar_str += self.scalars[s].getDmapPack(s)
-   
-    def _makeVectorStr(self):
-        self.vector_str = ''
+            sze += self.scalars[s].getPackSize(s)
         for v in self.vectors:
-            self.vector_str += self.vectors[v].getDmapPack(v)
-   
+            sze += self.vectors[v].getPackSize(v)
+        return sze
+
+    def packInto(self, buf, offset):
+        ''' encodes the record into writable buffer buf at offset, returns the offset after the record '''
+        return pack_fields(buf, offset, self.scalars, self.vectors)
+
+    def getBuffer(self):
+        ''' returns the encoded record, this is the buffer the record's variables write through to
+            the record is only encoded again if fields were added or resized since the last call,
+            vectors that were laid out again keep their arrays and are copied in on every call '''
+        if not self.layout.valid:
+            payloads = []
+            layout = dmap_layout(bytearray(self.getPackSize()))
+            pack_fields(layout.buf, 0, self.scalars, self.vectors, payloads)
+
+            fields = [self.scalars[s] for s in self.scalars] + [self.vectors[v] for v in self.vectors]
+            for var, offset in zip(fields, payloads):
+                if not var.bind(layout, offset):
+                    # nested maps can change without going through setData, encode the record every time
+                    layout.valid = False
+            self.layout = layout
+
+        for view, var in self.layout.copies:
+            view[...] = var.data
+        return self.layout.buf
+
+    def pack(self):
+        ''' returns a copy of the encoded record '''
+        return bytearray(self.getBuffer())
+
+    def _getVar(self, name):
+        if name in self.scalars:
+            return self.scalars[name]
+        return self.vectors[name]
+
+    def packColumns(self, columns, nrec = None):
+        ''' encodes nrec records in one buffer, each a copy of this record with the fields in columns replaced
+            columns maps field names to arrays with a leading record axis, fields must keep their shape
+            and strings their length from record to record '''
+        template = self.getBuffer()
+        if nrec is None:
+            nrec = len(next(iter(columns.values())))
+
+        if not self.layout.valid:
+            return self._packColumnRecords(columns, nrec)
+
+        recsize = len(template)
+        buf = bytearray(recsize * nrec)
+        records = np.frombuffer(buf, dtype = np.uint8).reshape(nrec, recsize)
+        records[:] = np.frombuffer(template, dtype = np.uint8)
+
+        for name in columns:
+            var = self._getVar(name)
+            if var.dtype == str:
+                for r in range(nrec):
+                    value = str(columns[name][r])
+                    if len(value) != len(var.data):
+                        raise ValueError('string column {} must keep length {}'.format(name, len(var.data)))
+                    struct.pack_into('%ds' % len(value), buf, r * recsize + var.offset, value)
+            else:
+                # view the field in every record at once, one record is recsize bytes after the last
+                shape = np.shape(var.data)
+                strides = (recsize,) + np.empty(shape, dtype = var.dtype).strides
+                field = np.ndarray((nrec,) + shape, dtype = DTYPE_NPDTYPES[var.dtype], buffer = buf, offset = var.offset, strides = strides)
+                field[...] = columns[name]
+
+        return buf
+
+    def _packColumnRecords(self, columns, nrec):
+        ''' packColumns for records holding nested maps, which have no fixed layout, sets and encodes each record in turn '''
+        saved = dict((name, self._getVar(name).getData()) for name in columns)
+        buf = bytearray()
+        for r in range(nrec):
+            for name in columns:
+                self._getVar(name).setData(columns[name][r])
+            buf += self.getBuffer()
+
+        for name in saved:
+            self._getVar(name).setData(saved[name])
+        return buf
+
     def write(self):
-        self._makeScalarStr()
-        self._makeVectorStr()
-        self._makeHeader()
-        
-        self.dmap_file.write(self.header)
-        self.dmap_file.write(self.scalar_str)
-        self.dmap_file.write(self.vector_str)
+        self.dmap_file.write(self.getBuffer())
+
+    def writeColumns(self, columns, nrec = None):
+        ''' writes the nrec records built by packColumns with a single write '''
+        self.dmap_file.write(self.packColumns(columns, nrec))
 
     def close(self):
         if self.filename:
@@ -165,58 +489,31 @@ class dmap_record(object):
 
     def addScalar(self, name, val, dtype):
         self.scalars[name] = dmap_var(val, dtype)
-    
+        self.layout.valid = False
+
     # create an array of type dtype of shape shape with default value dval
     def addVectorBlank(self, name, dval, shape, dtype):
-        val = dval * np.ones(shape, dtype=dtype) 
+        val = dval * np.ones(shape, dtype=dtype)
         self.vectors[name] = dmap_var(val, dtype)
+        self.layout.valid = False
 
     def addVector(self, name, data, dtype):
-        self.addVectorBlank(name, 0, data.shape, dtype)
-        self.vectors[name].setData(data)
+        self.vectors[name] = dmap_var(np.asarray(data), dtype)
+        self.layout.valid = False
 
 
 class fitacf_record(dmap_record):
-    def __init__(self, scalars = {}, vectors = {}):
-        dmap_record.__init__(self) 
-        self.addScalar('fitacf.revision.major', 0, np.int32)
-        self.addScalar('fitacf.revision.minor', 0, np.int32)
-        self.addScalar('noise.sky', 0, np.float32)
-        self.addScalar('noise.lag0', 0, np.float32)
-        self.addScalar('noise.vel', 0, np.float32)
-
-        for s in scalars:
-            self.scalars[s].setData(scalars[s])
+    SCALARS = FITACF_SCALARS
+    VECTORS = FITACF_VECTORS
 
-        self.addVectorBlank('ptab', 0, (self.scalars['mppul'].getData()), np.int16)
-        self.addVectorBlank('ltab', 0, (2, self.scalars['mplgs'].getData()), np.int16)
-        self.addVectorBlank('pwr0', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('slist', 0, (self.scalars['nrang'].getData()), np.int16)
-        self.addVectorBlank('nlag', 0, (self.scalars['nrang'].getData()), np.int16)
-        self.addVectorBlank('qflg', 0, (self.scalars['nrang'].getData()), np.uint8)
-        self.addVectorBlank('gflg', 0, (self.scalars['nrang'].getData()), np.uint8)
-        self.addVectorBlank('p_l', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('p_l_e', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('p_s', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('p_s_e', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('v', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('v_e', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('w_l', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('w_l_e', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('w_s', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('w_s_e', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('sd_l', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('sd_s', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('sd_phi', 0, (self.scalars['nrang'].getData()), np.float32)
-        
-        for v in vectors:
-            self.vectors[v].setData(vectors[v])
+    def __init__(self, scalars = {}, vectors = {}):
+        dmap_record.__init__(self, scalars = scalars, vectors = vectors)
 
 
 def main():
     dmap_file = file('sandbox/temp.rawacf', 'w')
     dmap_r = dmap_record()
-   
+
     dmap_r.write(dmap_file)
 
     dmap_file.close()
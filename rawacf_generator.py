@@ -4,8 +4,11 @@ import numpy as np
 import datetime
 import sys
 import pdb
-from pydmap_write import dmap_record
+import multiprocessing
+from pydmap_write import dmap_record, RECORD_SCALARS, time_columns
 from superdarn_tools import *
+from lag_cache import get_lag_table
+from noise_engine import noise_engine, record_noise_engine
 
 ISAMP = 0
 QSAMP = 1
@@ -52,6 +55,31 @@ LTAB = np.array([ \
 
 
 SLIST = np.arange(NRANG)
+GATE_VECTORS = ['slist', 'acfd', 'xcfd'] # vectors indexed by slist
+
+# interferometer geometry for deriving xcfd
+INTF_SEP = 100 # m, interferometer array separation from the main array
+BEAM_SEP = 3.24 # degrees between beams
+DEF_ELEVATION = 20 # degrees, elevation of synthetic scatter
+
+# defaults for synthesizing whole days
+CP = 150
+NBEAMS = 16
+INTT = 3 # seconds per beam
+SCAN_PERIOD = 60 # seconds between scan starts
+SECONDS_PER_DAY = 86400
+
+# per-beam target population for synthesize_day, targets per beam is a poisson mean
+DEF_TARGET_PARAMS = { \
+        'targets_per_beam' : 10, \
+        'velocity' : (-1000, 1000), \
+        'width' : (0, 500), \
+        'power' : (.1, 1), \
+        'noise' : .1, \
+        'ground' : False, \
+        'sea' : False, \
+        'elevation' : DEF_ELEVATION, \
+        'thr' : 0}
 DEF_SCALAR_OVERRIDES_45KM = { \
         'origin.time' : str(datetime.datetime.now()), \
         'origin.command' : ' '.join(sys.argv), \
@@ -74,29 +102,28 @@ DEF_VECTOR_OVERRIDES_45KM = {
         'ltab' : LTAB, \
         'slist' : SLIST}
 
-class rawacf_record(dmap_record):
-    def __init__(self, filename = '', scalars = DEF_SCALAR_OVERRIDES_45KM, vectors = DEF_VECTOR_OVERRIDES_45KM): 
-        dmap_record.__init__(self, filename = filename)
+RAWACF_SCALARS = RECORD_SCALARS + [ \
+    ('rawacf.revision.major', 5, np.int32),\
+    ('rawacf.revision.minor', 0, np.int32),\
+    ('thr', 0, np.float32)]
 
-        # create scalars and vectors with default args
-        self.addScalar('rawacf.revision.major', 5, np.int32)
-        self.addScalar('rawacf.revision.minor', 0, np.int32)
-        self.addScalar('thr', 0, np.float32)
+RAWACF_VECTORS = [ \
+    ('ptab', 0, ('mppul',), np.int16),\
+    ('ltab', 0, (2, 'mplgs'), np.int16),\
+    ('slist', 0, ('nrang',), np.int16),\
+    ('pwr0', 0, ('nrang',), np.float32),\
+    ('acfd', 0, ('nrang', 'mplgs', 2), np.float32),\
+    ('xcfd', 0, ('nrang', 'mplgs', 2), np.float32)]
 
-        for s in scalars:
-            self.scalars[s].setData(scalars[s])
+class rawacf_record(dmap_record):
+    SCALARS = RAWACF_SCALARS
+    VECTORS = RAWACF_VECTORS
 
-        self.addVectorBlank('ptab', 0, (self.scalars['mppul'].getData()), np.int16)
-        self.addVectorBlank('ltab', 0, (2, self.scalars['mplgs'].getData()), np.int16)
-        self.addVectorBlank('slist', 0, (self.scalars['nrang'].getData()), np.int16)
-        self.addVectorBlank('pwr0', 0, (self.scalars['nrang'].getData()), np.float32)
-        self.addVectorBlank('acfd', 0, (self.scalars['nrang'].getData(), self.scalars['mplgs'].getData(), 2), np.float32)
-        self.addVectorBlank('xcfd', 0, (self.scalars['nrang'].getData(), self.scalars['mplgs'].getData(), 2), np.float32)
+    def __init__(self, filename = '', scalars = DEF_SCALAR_OVERRIDES_45KM, vectors = DEF_VECTOR_OVERRIDES_45KM): 
+        # scalars and vectors are laid out from a schema compiled once per shape, then overridden in place
+        dmap_record.__init__(self, filename = filename, scalars = scalars, vectors = vectors)
 
-        for v in vectors:
-            self.vectors[v].setData(vectors[v])
-        
-        self.targets = []
+        self.targets = target_catalog()
 
     def setDefaults(rsep = 45):
         ''' sets sane default parameters for a given rsep (km)'''
@@ -105,58 +132,235 @@ class rawacf_record(dmap_record):
         else:
             NotImplementedError('rsep {} km does not have defaults implemented'.format(rsep)) 
     
-    def addScatter(self, rgate, velocity, spectral_width = 0, model = LAMBDA_FIT):
-        ''' add scatter to acfd at gate rgate with velocity (m/s) and spectral_width (m/s) '''
-        v = descale_velocity(velocity, self.scalars['tfreq'].data)
-        w = descale_width(spectral_width, self.scalars['tfreq'].data)
-        lagt = calc_lag_times(self.vectors['ltab'].data, self.scalars['mplgs'].data, self.scalars['mpinc'].data)
-        envelope = np.exp(-np.power(w, model) * np.power(lagt, model))
-        thetas = 2 * np.pi * lagt * v
+    def getLagTable(self):
+        ''' returns the shared lag_table of the record's pulse sequence '''
+        s = self.scalars
+        return get_lag_table(self.vectors['ptab'].data, self.vectors['ltab'].data, s['mplgs'].data, s['mpinc'].data, \
+                s['smsep'].data, s['txpl'].data, s['lagfr'].data, s['nrang'].data)
+
+    def addScatter(self, rgate, velocity, spectral_width = 0, power = 1, model = LAMBDA_FIT):
+        ''' add scatter to acfd at gate rgate with velocity (m/s), spectral_width (m/s) and lag 0 power '''
+        self.addScatterBatch([rgate], [velocity], [spectral_width], [power], model = model)
 
-        samples_real = envelope * (np.cos(thetas))
-        samples_imag = envelope * (np.sin(thetas))
+    def addScatterBatch(self, rgates, velocities, spectral_widths, powers = 1, model = LAMBDA_FIT, acfd = None):
+        ''' add scatter from many targets at once, rgates, velocities (m/s), spectral_widths (m/s) and powers are per target
+            lag times are computed once and all targets are evaluated together, targets sharing a gate add up
+            scatter goes to the record's acfd, or to acfd (nrang, mplgs, 2) if given '''
+        rgates = np.asarray(rgates, dtype = np.intp)
+        if not rgates.size:
+            return
+
+        # targets along the first axis, lags along the second
+        v = descale_velocity(np.asarray(velocities, dtype = np.float64), self.scalars['tfreq'].data).reshape(-1, 1)
+        w = descale_width(np.asarray(spectral_widths, dtype = np.float64), self.scalars['tfreq'].data).reshape(-1, 1)
+        p = np.asarray(powers, dtype = np.float64).reshape(-1, 1)
+        lagt = self.getLagTable().lagt
+
+        envelope = p * np.exp(-np.power(w, model) * np.power(lagt, model))
+        thetas = 2 * np.pi * lagt * v
 
         # TODO: calculate phase offset with back array
-        self.vectors['acfd'].data[rgate,:,ISAMP] += samples_real
-        self.vectors['acfd'].data[rgate,:,QSAMP] += samples_imag
+        samples_real = np.broadcast_to(envelope * np.cos(thetas), (rgates.size, lagt.size))
+        samples_imag = np.broadcast_to(envelope * np.sin(thetas), (rgates.size, lagt.size))
 
-    def addTarget(self, target):
-        ''' add targets to a list of targets to generate scatter from using generateScatter '''
-        self.targets.append(target)
+        # accumulate targets into their gates with bincount over flattened (gate, lag) indices, like np.add.at but faster
+        if acfd is None:
+            acfd = self.vectors['acfd'].data
+        nrang, mplgs = acfd.shape[:2]
+        bins = (rgates.reshape(-1, 1) * mplgs + np.arange(mplgs)).ravel()
+        acfd[:,:,ISAMP] += np.bincount(bins, weights = samples_real.ravel(), minlength = nrang * mplgs).reshape(nrang, mplgs)
+        acfd[:,:,QSAMP] += np.bincount(bins, weights = samples_imag.ravel(), minlength = nrang * mplgs).reshape(nrang, mplgs)
 
-    def generateScatter(self):
-        ''' generate scatter interference using a list of targets '''
-        # currently without cross-range interference..
+    def addCatalog(self, catalog, model = LAMBDA_FIT, acfd = None):
+        ''' add scatter from every target of a target_catalog, see addScatterBatch '''
+        self.addScatterBatch(catalog['rangegate'], catalog['velocity'], catalog['width'], catalog['power'], model = model, acfd = acfd)
+
+    def addTarget(self, targets):
+        ''' add a target or a target_catalog to the targets to generate scatter from using generateScatter '''
+        if isinstance(targets, target):
+            targets = target_catalog.fromTargets([targets])
+        self.targets = self.targets.concatenate(targets)
 
-        for t in self.targets:
-            self.addScatter(t.rangegate, t.velocity, t.width)
+    def generateScatter(self, model = LAMBDA_FIT):
+        ''' generate scatter interference from the target catalog '''
+        # currently without cross-range interference..
+        t = self.targets
+        self.addScatterBatch(t['rangegate'], t['velocity'], t['width'], t['power'], model = model)
         
 
     def calcPwr0(self):
-        ''' calculates pwr0 vector from acfd '''
-        # TODO: IMPLEMENT ME
-        acfd = self.vectors['acfd'].getData()
-        pwr0 = np.sum(np.power(acfd[:,0],2),axis=1)
+        ''' calculates pwr0 vector from acfd, the real part of lag 0 '''
+        self.vectors['pwr0'].setData(self.vectors['acfd'].data[:,0,ISAMP])
+
+    def beamPhi(self, nbeams = NBEAMS):
+        ''' returns the direction (degrees off boresight) of the record's beam '''
+        return (self.scalars['bmnum'].data - (nbeams - 1) / 2.) * BEAM_SEP
+
+    def finalize(self, elevation = DEF_ELEVATION, engine = None, noise = 0, thr = 0):
+        ''' finishes a record holding synthesized scatter with finalize_acfs:
+            derives xcfd from the scatter arriving at elevation (degrees, scalar or per gate), adds noise of power noise from engine,
+            sets pwr0, noise.search, noise.mean, xcf and thr, returns the mask of the gates to keep in slist (all of them if thr is 0)
+            the record keeps every gate so it can be reused, packGates encodes a copy holding only the kept ones '''
+        if engine is None and noise:
+            engine = _default_noise
+        tfreq = self.scalars['tfreq'].data
+        nrang = self.scalars['nrang'].data
+        psi = interferometer_phase(np.broadcast_to(elevation, (nrang,)), self.beamPhi(), tfreq)
+
+        acfd = self.vectors['acfd'].data
+        xcfd = self.vectors['xcfd'].data
+        pwr0, search, mean, gates = finalize_acfs(acfd, xcfd, psi, thr, engine, noise, self.scalars['nave'].data)
+
         self.vectors['pwr0'].setData(pwr0)
+        self.scalars['noise.search'].setData(search)
+        self.scalars['noise.mean'].setData(mean)
+        self.scalars['xcf'].setData(1)
+        self.scalars['thr'].setData(thr)
+        return gates
 
-    def applyNoise(self, level, noisemodel = np.random.randn):
-        '''Apply noise of power 'noise' with model 'model' to all lag'''
-        acfd = self.vectors['acfd'].getData()
-        xcfd = self.vectors['xcfd'].getData()
-        
-        acfd += level * (noisemodel(*acfd.shape))
-        xcfd += level * (noisemodel(*acfd.shape))
-        
-        self.vectors['acfd'].setData(acfd)
-        self.vectors['xcfd'].setData(xcfd)
+    def packGates(self, gates):
+        ''' returns a copy of the encoded record with slist, acfd and xcfd holding only the gates in mask gates,
+            the record itself keeps all of its gates '''
+        if gates.all():
+            return self.pack()
+
+        saved = dict((v, np.array(self.vectors[v].getData())) for v in GATE_VECTORS)
+        self.vectors['slist'].setData(np.flatnonzero(gates))
+        self.vectors['acfd'].setData(saved['acfd'][gates])
+        self.vectors['xcfd'].setData(saved['xcfd'][gates])
+        buf = self.pack()
+
+        for v in GATE_VECTORS:
+            self.vectors[v].setData(saved[v])
+        return buf
+
+    def applyNoise(self, level, engine = None):
+        ''' adds receiver noise of power level to acfd and xcfd in place, with the statistics of nave averaged acfs
+            noise is drawn from engine, a noise_engine, so records can be reproduced from their own random streams '''
+        if engine is None:
+            engine = _default_noise
+        nave = self.scalars['nave'].data
+        engine.addNoise(self.vectors['acfd'].data, level, nave)
+        engine.addNoise(self.vectors['xcfd'].data, level, nave, cross = True)
+
+    def addClutter(self, engine, ground = True, sea = False, acfd = None):
+        ''' adds ground scatter and/or sea clutter drawn from engine to acfd (the record's by default) '''
+        nrang = self.scalars['nrang'].data
+        if ground:
+            self.addCatalog(engine.groundScatter(nrang), acfd = acfd)
+        if sea:
+            self.addCatalog(engine.seaClutter(nrang, self.scalars['tfreq'].data), acfd = acfd)
+
+def interferometer_phase(elevation, phi, tfreq, sep = INTF_SEP):
+    ''' returns the phase (radians) of the interferometer signal relative to the main array for scatter arriving
+        at elevation (degrees) from phi (degrees off boresight), psi = k d sqrt(cos^2 phi - sin^2 elevation), tfreq in kHz '''
+    k = 2 * np.pi * tfreq * 1000. / C
+    elevation = np.radians(elevation)
+    phi = np.radians(phi)
+    return k * sep * np.sqrt(np.maximum(np.cos(phi) ** 2 - np.sin(elevation) ** 2, 0))
+
+def finalize_acfs(acfd, xcfd, psi, thr = 0, engine = None, noise = 0, nave = NAVE):
+    ''' post synthesis pass over acfd and xcfd holding scatter only, one record (nrang, mplgs, 2) or a stack of them (.., nrang, mplgs, 2)
+        xcfd gets the scatter rotated by the interferometer phase psi (.., nrang), engine adds noise of power noise to both in place,
+        returns pwr0 (.., nrang), the search and mean noise estimates (..) from superdarn_tools.calc_noise
+        and a (.., nrang) mask of the gates for slist, those with pwr0 at least thr times the mean noise (every gate if thr is 0) '''
+    c = np.cos(psi)[...,np.newaxis]
+    s = np.sin(psi)[...,np.newaxis]
+    xcfd[...,ISAMP] += acfd[...,ISAMP] * c - acfd[...,QSAMP] * s
+    xcfd[...,QSAMP] += acfd[...,ISAMP] * s + acfd[...,QSAMP] * c
+
+    if engine is not None:
+        engine.addNoise(acfd, noise, nave)
+        engine.addNoise(xcfd, noise, nave, cross = True)
+
+    pwr0 = acfd[...,0,ISAMP].copy()
+    search, mean = calc_noise(pwr0, np.hypot(acfd[...,ISAMP], acfd[...,QSAMP]))
+    if thr > 0:
+        gates = pwr0 >= thr * mean[...,np.newaxis]
+    else:
+        gates = np.ones(pwr0.shape, dtype = bool)
+    return pwr0, search, mean, gates
+
+# noise for records not given their own stream
+_default_noise = noise_engine(np.random.RandomState())
+
+def synthesize_scan(task):
+    ''' generates every beam of one scan, returns the encoded records
+        task is (scan number, scan start time, seed, nbeams, intt, cp, target params),
+        each scan draws from its own random stream seeded by (seed, scan number), so results don't depend on scheduling '''
+    scannum, stime, seed, nbeams, intt, cp, params = task
+    engine = record_noise_engine(seed, scannum)
+
+    record = rawacf_record()
+    record.scalars['cp'].setData(cp)
+    record.scalars['intt.sc'].setData(int(intt))
+    record.scalars['intt.us'].setData(int(round((intt % 1) * 1e6)))
+    record.scalars['xcf'].setData(1)
+    record.scalars['thr'].setData(params.get('thr', 0))
+    nrang = record.scalars['nrang'].data
+
+    acfds = np.zeros((nbeams,) + record.vectors['acfd'].data.shape, dtype = np.float32)
+    xcfds = np.zeros_like(acfds)
+
+    for beam in range(nbeams):
+        targets = target_catalog.random(engine.rng.poisson(params['targets_per_beam']), nrang, \
+                params['velocity'], params['width'], params['power'], rng = engine.rng)
+        record.addCatalog(targets, acfd = acfds[beam])
+        if params.get('ground') or params.get('sea'):
+            record.addClutter(engine, ground = params.get('ground'), sea = params.get('sea'), acfd = acfds[beam])
+
+    # xcfd, noise, pwr0, noise estimates and slist for the whole scan in one pass
+    phi = (np.arange(nbeams) - (nbeams - 1) / 2.) * BEAM_SEP
+    elevation = np.broadcast_to(params.get('elevation', DEF_ELEVATION), (nrang,))
+    psi = interferometer_phase(elevation[np.newaxis,:], phi[:,np.newaxis], record.scalars['tfreq'].data)
+    pwr0s, search, mean, gates = finalize_acfs(acfds, xcfds, psi, params.get('thr', 0), engine, params['noise'], record.scalars['nave'].data)
+
+    times = [stime + datetime.timedelta(seconds = beam * intt) for beam in range(nbeams)]
+    columns = time_columns(times)
+    columns['bmnum'] = np.arange(nbeams)
+    columns['scan'] = (np.arange(nbeams) == 0).astype(np.int16)
+    columns['noise.search'] = search
+    columns['noise.mean'] = mean
+    columns['pwr0'] = pwr0s
+
+    if gates.all():
+        columns['acfd'] = acfds
+        columns['xcfd'] = xcfds
+        return bytes(record.packColumns(columns))
+
+    # slist differs between beams, so the records don't share a layout
+    blocks = []
+    for beam in range(nbeams):
+        for name in columns:
+            record._getVar(name).setData(columns[name][beam])
+        record.vectors['slist'].setData(np.flatnonzero(gates[beam]))
+        record.vectors['acfd'].setData(acfds[beam][gates[beam]])
+        record.vectors['xcfd'].setData(xcfds[beam][gates[beam]])
+        blocks.append(bytes(record.getBuffer()))
+    return ''.join(blocks)
+
+def synthesize_day(filename, day, cp = CP, nbeams = NBEAMS, intt = INTT, scan_period = SCAN_PERIOD, seed = 0, processes = None, params = DEF_TARGET_PARAMS):
+    ''' writes a synthetic day of rawacf records to filename, starting at datetime day
+        scans are generated in parallel across a pool of processes and written in time order '''
+    nscans = int(SECONDS_PER_DAY // scan_period)
+    tasks = [(scannum, day + datetime.timedelta(seconds = scannum * scan_period), seed, nbeams, intt, cp, params) for scannum in range(nscans)]
 
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(filename, 'wb') as f:
+            # imap hands results back in task order, so scans land in the file in time order
+            for block in pool.imap(synthesize_scan, tasks, chunksize = 4):
+                f.write(block)
+    finally:
+        pool.terminate()
+        pool.join()
 
 def main():
     test_record = rawacf_record(filename = 'sandbox/test.rawacf', scalars = DEF_SCALAR_OVERRIDES_45KM, vectors = DEF_VECTOR_OVERRIDES_45KM)
 
     test_record.setTime(datetime.datetime.now())
-    test_record.applyNoise(.01)    
     test_record.addScatter(0, 200, 200, model = LAMBDA_FIT)
+    test_record.finalize(engine = _default_noise, noise = .01)
 
     test_record.write()
  
@@ -1,14 +1,11 @@
 import numpy as np
-import re
-import subprocess
-import time
+from pydmap_read import dmap_file_reader
 
 C = 3e8
 LAMBDA_FIT = 1
 SIGMA_FIT = 2
-
-VECTOR_SPLITTER = 'short|float|int|char'
-ELEM_SPLITTER = '\n|\t'
+NOISE_GATES = 10 # lowest power gates averaged for the search noise
+NOISE_SPREAD = 1.6 # upper bound of noise as a multiple of the search noise, because fitacf does it that way
 
 
 class target(object):
@@ -25,8 +22,124 @@ class target(object):
     def __str__(self):
         return 'r: {}, p: {}, v: {}, w: {}, nl: {}, v_e: {}, w_e: {}'.format(self.rangegate, self.power, self.velocity, self.width, self.nlag, self.v_e, self.w_e)
 
+# target field -> fitted parameter field (fitacf vectors and fit_compare gate tables)
+TARGET_FIT_FIELDS = [ \
+    ('velocity', 'v'),\
+    ('width', 'w_l'),\
+    ('power', 'p_l'),\
+    ('v_e', 'v_e'),\
+    ('w_e', 'w_l_e'),\
+    ('nlag', 'nlag')]
+
+TARGET_DTYPE = np.dtype([ \
+    ('time', np.float64),\
+    ('bmnum', np.int16),\
+    ('rangegate', np.int16),\
+    ('velocity', np.float32),\
+    ('width', np.float32),\
+    ('power', np.float32),\
+    ('v_e', np.float32),\
+    ('w_e', np.float32),\
+    ('nlag', np.int16)])
+
+class target_catalog(object):
+    ''' structure of arrays catalog of targets, one TARGET_DTYPE row per target
+        catalog['velocity'] is a column, indexing with an int returns a target and with a slice or mask a catalog '''
+    __slots__ = ['targets']
+
+    def __init__(self, targets = None, size = 0):
+        if targets is None:
+            targets = np.zeros(size, dtype = TARGET_DTYPE)
+        self.targets = targets
+
+    @classmethod
+    def random(cls, n, nrang, velocity = (-1000, 1000), width = (0, 500), power = (.1, 1), rng = np.random):
+        ''' draws n targets at uniformly random gates below nrang with velocity, width and power uniform over (low, high) '''
+        catalog = cls(size = n)
+        catalog.targets['rangegate'] = rng_integers(rng, 0, nrang, n)
+        catalog.targets['velocity'] = rng.uniform(velocity[0], velocity[1], n)
+        catalog.targets['width'] = rng.uniform(width[0], width[1], n)
+        catalog.targets['power'] = rng.uniform(power[0], power[1], n)
+        return catalog
+
+    @classmethod
+    def fromTargets(cls, targets):
+        ''' builds a catalog from a list of target objects '''
+        catalog = cls(size = len(targets))
+        for field in ['rangegate', 'velocity', 'width', 'power', 'v_e', 'w_e', 'nlag']:
+            catalog.targets[field] = [getattr(t, field) for t in targets]
+        return catalog
+
+    @classmethod
+    def fromGates(cls, gates):
+        ''' builds a catalog from a fit_compare gate table of fitted parameters '''
+        catalog = cls(size = len(gates))
+        catalog.targets['time'] = gates['time']
+        catalog.targets['bmnum'] = gates['bmnum']
+        catalog.targets['rangegate'] = gates['gate']
+        for field, fit_field in TARGET_FIT_FIELDS:
+            catalog.targets[field] = gates[fit_field]
+        return catalog
+
+    def toGates(self, dtype):
+        ''' returns the catalog as a gate table of dtype (fit_compare.GATE_DTYPE), to compare against fitted gates '''
+        gates = np.zeros(len(self), dtype = dtype)
+        gates['time'] = self.targets['time']
+        gates['bmnum'] = self.targets['bmnum']
+        gates['gate'] = self.targets['rangegate']
+        for field, fit_field in TARGET_FIT_FIELDS:
+            gates[fit_field] = self.targets[field]
+        return gates
+
+    def filter(self, mask):
+        ''' returns a catalog of the targets selected by boolean mask or index array '''
+        return target_catalog(self.targets[mask])
+
+    def select(self, **ranges):
+        ''' returns a catalog of the targets with low <= field < high for each field = (low, high) keyword '''
+        mask = np.ones(len(self), dtype = bool)
+        for field, (low, high) in ranges.items():
+            mask &= (self.targets[field] >= low) & (self.targets[field] < high)
+        return self.filter(mask)
+
+    def concatenate(self, *catalogs):
+        ''' returns a catalog of these targets followed by those of catalogs '''
+        return target_catalog(np.concatenate([self.targets] + [c.targets for c in catalogs]))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.targets[key]
+        if isinstance(key, (int, np.integer)):
+            t = self.targets[key]
+            return target(rangegate = t['rangegate'], velocity = t['velocity'], width = t['width'], power = t['power'], v_e = t['v_e'], w_e = t['w_e'], nlag = t['nlag'])
+        return self.filter(key)
+
+    def __setitem__(self, key, value):
+        self.targets[key] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def make_rng(seed, *streams):
+    ''' returns an independent random stream for (seed, streams..), a numpy Generator where numpy has them, otherwise a RandomState '''
+    key = [seed] + list(streams)
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(key)
+    return np.random.RandomState(key)
+
+def rng_integers(rng, low, high, size = None):
+    ''' uniform integers in [low, high) from a Generator or a RandomState '''
+    if hasattr(rng, 'integers'):
+        return rng.integers(low, high, size)
+    return rng.randint(low, high, size)
+
 def calc_lag_times(ltab, mplgs, mpinc):
-    return np.float32(np.array(map(lambda x : abs(x[1]-x[0]), ltab[0:mplgs])) * (mpinc / 1e6))
+    ltab = np.asarray(ltab)[0:mplgs]
+    return np.float32(np.abs(ltab[:,1] - ltab[:,0]) * (mpinc / 1e6))
 
 
 def descale_velocity(v, tfreq):
@@ -38,67 +151,31 @@ def descale_width(w, tfreq):
 
     return w * 2. * np.pi * tfreq * 1000 / C
 
-# grabs the tail off a dmap dump of a fitacf from a remote radar 
-def get_dmapdumpstring(lines = 200):
-    cmd = 'dmapdump -d `ls -t ~/repos/SuperDARN_pydmap_write/sandbox/*.fitacf | head -1` | tail -n ' + str(int(lines))
-    return subprocess.check_output(cmd, shell=True)
-
-# gets data from latest dmapdump, load variables into dict, return dict 
-# grab the last 200 lines or so to ensure a full record
-def parse_dmapdumpstring(dumpstring):
+# decodes record recnum (the last one by default) of a dmap file, load variables into dict, return dict
+def read_dmap_scandata(filename, recnum = -1):
     scandata = {}
-    scan = dumpstring.split('scalars:')[-1].split('arrays:')
-    scalars = scan[0].split('\n')
-    vectors = re.split(VECTOR_SPLITTER, scan[1])
-    for scalar in scalars:
-        if scalar == '':
-            continue
-        assignment = scalar.split('\t')[-1].split(' = ')
-        var = assignment[0].lstrip('"').rstrip('"')
-        value = eval(assignment[1])
-        scandata[var] = value
-    for vector in vectors:
-        vector = vector.split('=')
-
-        if len(vector) <= 1:
-            continue
-        var = vector[0].split('"')[1]
-        vecvalue = []
-        for v in re.split(ELEM_SPLITTER, vector[1]):
-            v = v.rstrip(',')
-            if v == '':
-                continue
-            if v == 'inf' or v == 'nan' or v == '-nan':
-                v = 'float("NaN")'
-            try:
-                vecvalue.append(eval(v))
-            except:
-                print 'error parsing vector'
-
-        scandata[var] = np.array(vecvalue)
+    with dmap_file_reader(filename) as reader:
+        scalars, vectors = reader.readRecord(recnum)
+        scandata.update(scalars)
+        # copy vectors out of the memory map before it is closed
+        for v in vectors:
+            scandata[v] = np.array(vectors[v])
     return scandata
 
-'''
-def CalcNoise(pwr0, ):
-    # take average of smallest ten powers at range gate 0 for lower bound on noise
-    pnmin = np.mean(sorted(pwr0)[:10])
-
-    # take 1.6 * pnmin as upper bound for noise, 
-    pnmax = 1.6 * pnmin # why 1.6? because fitacf does it that way...
-
-    noise_samples = np.array([])
-
-    # look through good lags for ranges with pnmin, pnmax for more noise samples
-    noise_ranges = (pwr0 > pnmin) * (pwr0 < pnmax)
-
-    for r in np.nonzero(noise_ranges)[0]:
-        t, samples = self._CalcSamples(r)
-
-        noise_lags = np.nonzero((abs(samples) > pnmin) * (abs(samples) < pnmax))[0]
-        noise_samples = np.append(noise_samples, abs(samples)[noise_lags])
-
-    # set noise as average of noise samples between pnmin and pnmax
-    if len(noise_samples):
-        self.noise = np.mean(noise_samples)
-'''
-
+def calc_noise(pwr0, mags):
+    ''' estimates noise the way fitacf does, for one record or batched over leading axes
+        pwr0 is (.., nrang) lag 0 power and mags (.., nrang, mplgs) acf magnitudes
+        returns the mean of the NOISE_GATES lowest powers as the search noise (a lower bound), and the mean noise,
+        the average of the acf magnitudes between the search noise and NOISE_SPREAD times it at gates whose power is also in that band,
+        records with fewer than NOISE_GATES gates average all of them '''
+    lowest = min(NOISE_GATES, pwr0.shape[-1])
+    pnmin = np.partition(pwr0, lowest - 1, axis = -1)[...,:lowest].mean(axis = -1)
+    pnmax = NOISE_SPREAD * pnmin
+
+    gates = (pwr0 > pnmin[...,np.newaxis]) & (pwr0 < pnmax[...,np.newaxis])
+    samples = gates[...,np.newaxis] & (mags > pnmin[...,np.newaxis,np.newaxis]) & (mags < pnmax[...,np.newaxis,np.newaxis])
+
+    count = samples.sum(axis = -1).sum(axis = -1)
+    total = np.where(samples, mags, 0).sum(axis = -1).sum(axis = -1)
+    mean = np.where(count > 0, total / np.maximum(count, 1), pnmin)
+    return pnmin, mean[()]